@@ -1,192 +1,752 @@
 import os
 import sys
 import json
+import re
+import asyncio
+import datetime
+import functools
+import itertools
+import logging
 import pandas as pd
+import openpyxl
 import sqlite3
 import argparse
 import hashlib
-from openai import OpenAI
+import tempfile
+import threading
+import mmap
+import pathlib
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 from dotenv import load_dotenv
 
+try:
+    import xxhash
+except ImportError:  # без xxhash используем встроенный blake2b
+    xxhash = None
+
+try:
+    import duckdb
+except ImportError:  # без duckdb все запросы выполняются в SQLite
+    duckdb = None
+
+try:
+    import orjson
+except ImportError:  # без orjson используем стандартный json
+    orjson = None
+
+try:
+    import tiktoken
+except ImportError:  # без tiktoken число токенов оценивается по длине текста
+    tiktoken = None
+
 load_dotenv()
 
-# Глобальный кэш для хранения обработанных файлов
-file_cache = {}
+# Ход работы (загрузка книги, SQL, предупреждения) пишется в лог: при запуске скрипта он выводится
+# в stdout, а бот, который вызывает ExcelQA в своём процессе, сам решает, что из этого показывать
+logger = logging.getLogger(__name__)
+
+# Каталог дискового кэша: SQLite-база и описание листов для каждого уникального содержимого файла
+DEFAULT_CACHE_DIR = '.excel_cache'
+# Версия формата кэша: увеличивается при изменении способа загрузки данных, чтобы старый кэш не использовался
+CACHE_VERSION = 3
+# Размер блока при хешировании: ограничивает объём страниц файла, затрагиваемых за один вызов
+HASH_CHUNK_SIZE = 16 * 1024 * 1024
+# Число строк Excel, передаваемых в SQLite одним вызовом executemany
+IMPORT_BATCH_SIZE = 10000
+# Файлы не больше этого размера в режиме --engine auto загружаются в DuckDB прямо в памяти
+DUCKDB_MAX_FILE_SIZE = 10 * 1024 * 1024
+# Интервал опроса статуса пакетного задания OpenAI Batch API (в секундах)
+BATCH_POLL_INTERVAL = 30
+
+# Блок кода с SQL в ответе модели: ```sql ... ``` или просто ``` ... ```
+SQL_FENCE_RE = re.compile(r"```(?:sql)?[ \t]*\n?(.*?)```", re.DOTALL | re.IGNORECASE)
+
+# Ограничение числа одновременных соединений с API OpenAI (защита от rate limit)
+OPENAI_MAX_CONNECTIONS = 50
+
+# Размер контекста моделей (в токенах); для неизвестных моделей берётся наименьший
+MODEL_CONTEXT_TOKENS = {
+    'gpt-4o': 128000,
+    'gpt-4.1': 1000000,
+    'gpt-4-turbo': 128000,
+    'gpt-3.5-turbo': 16000,
+    'gpt-4': 8192,
+}
+# Запас токенов на промпт SQL-запроса и ответ модели
+RESPONSE_TOKEN_RESERVE = 2000
+# Сколько последних сообщений истории сохраняется всегда (два последних обмена репликами)
+KEEP_LAST_MESSAGES = 4
+
+# Настройки SQLite для быстрой массовой загрузки данных из Excel
+SQLITE_IMPORT_PRAGMAS = """
+PRAGMA journal_mode = WAL;
+PRAGMA synchronous = OFF;
+PRAGMA temp_store = MEMORY;
+PRAGMA cache_size = -262144;
+"""
+# Объём файла кэшированной базы, отображаемый в память: страницы читаются из кэша ОС без копирования
+SQLITE_MMAP_SIZE = 1024 * 1024 * 1024
+
 
+def quote_identifier(name):
+    """Экранирует имя таблицы или столбца для подстановки в SQL."""
+    return '"' + name.replace('"', '""') + '"'
 
-def chat_with_gpt(client, model, messages, temperature=0):
-    """Удобная обёртка для вызова GPT через API с поддержкой истории чата."""
+
+# Имя таблицы с данными и постоянные тексты служебных запросов к ней: текст не собирается
+# заново при каждом вызове, поэтому SQLite берёт готовое выражение из кэша соединения
+TABLE_NAME = 'data'
+TABLE_INFO_SQL = f"PRAGMA table_info({quote_identifier(TABLE_NAME)})"
+SAMPLE_ROWS_SQL = f"SELECT * FROM {quote_identifier(TABLE_NAME)} LIMIT 5"
+
+# Даты и время из ячеек Excel записываются в SQLite строками (datetime и date sqlite3 умеет сам)
+sqlite3.register_adapter(datetime.time, datetime.time.isoformat)
+sqlite3.register_adapter(datetime.timedelta, str)
+
+
+async def chat_with_gpt(client, model, messages, temperature=0):
+    """Асинхронная обёртка для вызова GPT через API с поддержкой истории чата."""
     try:
-        response = client.chat.completions.create(
+        response = await client.chat.completions.create(
             model=model,
             messages=messages,
             temperature=temperature
         )
         return response.choices[0].message.content
     except Exception as e:
-        print(f"Ошибка при вызове API OpenAI: {e}")
+        logger.error(f"Ошибка при вызове API OpenAI: {e}")
         return f"Произошла ошибка при получении ответа: {e}"
 
 
+@functools.lru_cache(maxsize=None)
+def get_encoder(model):
+    """Токенизатор модели (загружается один раз); None, если tiktoken недоступен."""
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except Exception:
+        try:
+            return tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            logger.warning(f"Предупреждение: токенизатор недоступен, используется приблизительная оценка: {e}")
+            return None
+
+
+def prompt_token_budget(model):
+    """Сколько токенов можно отдать под сообщения запроса к модели."""
+    context = next((tokens for prefix, tokens in MODEL_CONTEXT_TOKENS.items() if model.startswith(prefix)),
+                   min(MODEL_CONTEXT_TOKENS.values()))
+    return context - RESPONSE_TOKEN_RESERVE
+
+
+def trim_messages(messages, model):
+    """Удаляет самые старые сообщения истории (кроме системного и последних), пока запрос не уложится в контекст."""
+    encoder = get_encoder(model)
+    # 4 токена — служебная разметка каждого сообщения
+    counts = [(len(encoder.encode(m["content"])) if encoder else len(m["content"]) // 4) + 4 for m in messages]
+    total = sum(counts)
+    budget = prompt_token_budget(model)
+
+    start = 1 if messages and messages[0]["role"] == "system" else 0
+    end = start
+    while total > budget and end < len(messages) - KEEP_LAST_MESSAGES:
+        total -= counts[end]
+        end += 1
+    if end > start:
+        del messages[start:end]
+        logger.info(f"История чата сокращена: удалено старых сообщений: {end - start}")
+    return messages
+
+
+def extract_sql(response):
+    """Извлекает SQL-запрос из ответа модели, если он обёрнут в блок кода ```sql ... ```."""
+    match = SQL_FENCE_RE.search(response)
+    return (match.group(1) if match else response).strip()
+
+
+def load_json_file(path):
+    """Читает JSON-файл одним открытием (без предварительной проверки существования)."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+def rows_to_json(rows):
+    """Сериализует строки таблицы в JSON одним вызовом (даты и прочие значения — строками)."""
+    if orjson is not None:
+        return orjson.dumps(rows, default=str).decode('utf-8')
+    return json.dumps(rows, ensure_ascii=False, default=str)
+
+
+def sheet_columns(header):
+    """Имена столбцов по строке заголовка: пустые и повторяющиеся называем так же, как pd.read_excel."""
+    columns = []
+    seen = {}
+    for i, name in enumerate(header):
+        name = f"Unnamed: {i}" if name is None else str(name)
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        columns.append(name)
+    return columns
+
+
+def column_type(value_types):
+    """Тип столбца SQLite по множеству Python-типов значений (как у pandas.to_sql)."""
+    value_types = value_types - {type(None)}
+    if not value_types:
+        return 'TEXT'
+    if value_types <= {int, bool}:
+        return 'INTEGER'
+    if value_types <= {int, float, bool}:
+        return 'REAL'
+    if value_types <= {datetime.datetime, datetime.date, datetime.time}:
+        return 'TIMESTAMP'
+    return 'TEXT'
+
+
+def data_rows(rows, width):
+    """Строки листа без полностью пустых строк в конце (в режиме read_only их часто много)."""
+    pending_empty = []
+    for row in rows:
+        if row.count(None) == width:
+            pending_empty.append(row)
+            continue
+        if pending_empty:
+            yield from pending_empty
+            pending_empty.clear()
+        yield row
+
+
+def duckdb_column(values, sql_type):
+    """Столбец DataFrame для DuckDB с типом, выведенным по значениям ячеек."""
+    try:
+        if sql_type == 'INTEGER':
+            return pd.array(values, dtype='Int64')
+        if sql_type == 'REAL':
+            return pd.array(values, dtype='Float64')
+        if sql_type == 'TIMESTAMP':
+            return pd.to_datetime(pd.Series(values, dtype=object)).astype('datetime64[us]')
+    except (TypeError, ValueError, OverflowError):
+        # Тип выведен по первой пачке строк; если дальше встретились другие значения, храним текст
+        pass
+    return pd.Series([None if value is None else str(value) for value in values], dtype=object)
+
+
+def resolve_engine(engine, file_path, cache):
+    """Выбирает движок SQL: в режиме auto DuckDB используется для небольших файлов без дискового кэша."""
+    if engine == 'auto':
+        if duckdb is not None and not cache and os.path.getsize(file_path) <= DUCKDB_MAX_FILE_SIZE:
+            return 'duckdb'
+        return 'sqlite'
+    if engine == 'duckdb' and duckdb is None:
+        logger.warning("Предупреждение: пакет duckdb не установлен, используется SQLite.")
+        return 'sqlite'
+    return engine
+
+
 def get_file_hash(file_path):
-    """Генерирует хеш файла для проверки изменений."""
-    h = hashlib.md5()
+    """Генерирует хеш файла для проверки изменений (некриптографический, только для ключа кэша)."""
+    h = xxhash.xxh3_64() if xxhash else hashlib.blake2b(digest_size=16)
     with open(file_path, 'rb') as file:
-        for chunk in iter(lambda: file.read(4096), b''):
-            h.update(chunk)
+        # mmap не поддерживает файлы нулевой длины
+        if os.fstat(file.fileno()).st_size == 0:
+            return h.hexdigest()
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+            for offset in range(0, len(view), HASH_CHUNK_SIZE):
+                h.update(view[offset:offset + HASH_CHUNK_SIZE])
     return h.hexdigest()
 
 
-def main():
-    # Парсинг аргументов командной строки
-    parser = argparse.ArgumentParser(description='Ответ на вопросы по данным из Excel-файла')
-    parser.add_argument('file_path', help='Путь к Excel-файлу')
-    parser.add_argument('query', help='Вопрос пользователя')
-    parser.add_argument('--api_key', help='API ключ OpenAI (или будет использован из переменной окружения)')
-    parser.add_argument('--model', default="gpt-4", help='Модель OpenAI (по умолчанию: gpt-4)')
-    parser.add_argument('--chat-history', help='Путь к JSON-файлу с историей чата')
-    parser.add_argument('--cache', action='store_true', help='Использовать кэширование данных')
+def open_cached_db(db_file):
+    """Открывает готовую базу из кэша только для чтения, с доступом к страницам через mmap."""
+    # check_same_thread=False: бот создаёт ExcelQA в потоке пула, а вопросы задаёт из цикла событий
+    conn = sqlite3.connect(f"{pathlib.Path(db_file).resolve().as_uri()}?mode=ro", uri=True,
+                           check_same_thread=False)
+    conn.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE}")
+    return conn
 
-    args = parser.parse_args()
 
-    # Проверка существования файла
-    if not os.path.exists(args.file_path):
-        print(f"Ошибка: файл {args.file_path} не найден.")
-        sys.exit(1)
+def schema_checksum(schema_str, examples_str):
+    """Контрольная сумма описания схемы, сохранённого в кэше (защита от повреждённого кэша)."""
+    payload = f"{schema_str}\0{examples_str}".encode('utf-8')
+    return hashlib.blake2b(payload, digest_size=16).hexdigest()
 
-    # Загружаем историю чата, если она есть
-    chat_history = []
-    if args.chat_history and os.path.exists(args.chat_history):
-        try:
-            with open(args.chat_history, 'r', encoding='utf-8') as f:
-                chat_history = json.load(f)
-            print(f"История чата загружена из {args.chat_history}")
-        except Exception as e:
-            print(f"Ошибка при загрузке истории чата: {e}")
-            # Продолжаем с пустой историей
-            chat_history = []
 
-    # Информация о запуске
-    print(f"Анализирую файл: {args.file_path}")
-    print(f"Вопрос пользователя: {args.query}")
+def unique_temp_path(path):
+    """Новый пустой временный файл рядом с path: своё имя у каждого вызова, даже из потоков одного процесса."""
+    fd, tmp_path = tempfile.mkstemp(prefix=f"{os.path.basename(path)}.", suffix='.tmp',
+                                    dir=os.path.dirname(path) or None)
+    os.close(fd)
+    return tmp_path
+
 
-    # Настройка API ключа
-    api_key = os.getenv("CHATGPT_API_KEY")
+def write_cache_meta(meta_file, meta):
+    """Атомарно записывает описание кэшированной базы (листы, схема, примеры строк)."""
+    meta_tmp = unique_temp_path(meta_file)
+    with open(meta_tmp, 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+    os.replace(meta_tmp, meta_file)
 
-    # Создание клиента OpenAI
-    client = OpenAI(api_key=api_key)
 
-    # Создание временного имени для базы данных
-    db_file = f"temp_db_{os.path.basename(args.file_path).replace('.', '_')}.sqlite"
-    table_name = 'data'  # Здесь всегда используем имя таблицы 'data'
+def build_system_prompt(table_name, schema_str, examples_str, sheet_names, dialect='SQLite'):
+    """Системный промпт с описанием таблицы и примерами строк."""
+    system_prompt = f"""Ты ассистент для анализа данных Excel. У меня есть таблица '{table_name}' в базе данных {dialect}.
+Таблица '{table_name}' содержит столбцы:
+{schema_str}
 
-    # Проверка наличия данных в кэше
-    file_hash = get_file_hash(args.file_path)
-    cache_key = f"{file_hash}_{db_file}"
+Примеры строк:
+{examples_str}
 
+Твоя задача - помогать анализировать данные из этой таблицы. 
+Отвечай на вопросы, генерируя SQL-запросы к данным, а затем объясняя результаты.
+Если нужно, используй подзапросы, группировку, объединения и другие SQL-конструкции для точного анализа.
+"""
+    # Добавляем информацию о структуре файла, если листов несколько
+    if len(sheet_names) > 1:
+        system_prompt += f"\nВажно: Excel-файл содержит {len(sheet_names)} листов: {', '.join(sheet_names)}.\n"
+        system_prompt += "Все данные из разных листов объединены в одну таблицу с дополнительным столбцом '_sheet_name', который указывает, из какого листа взята строка.\n"
+    return system_prompt
+
+
+def build_sql_prompt(query, table_name, sheet_names, dialect='SQLite'):
+    """Промпт для генерации SQL-запроса по вопросу пользователя."""
+    sql_prompt = f"""На основе предыдущей информации о таблице, напиши корректный SQL-запрос ({dialect}) для ответа на вопрос: "{query}"
+Важно: 
+1. Таблица называется '{table_name}' (не используй другое имя таблицы).
+2. Если имя столбца содержит пробелы или специальные символы, оборачивай его в двойные кавычки.
+"""
+    # Добавляем информацию о многолистовой структуре, если нужно
+    if len(sheet_names) > 1:
+        sql_prompt += f"3. В таблице есть столбец '_sheet_name', который указывает, из какого листа Excel взята строка ({', '.join(sheet_names)}).\n"
+        sql_prompt += "   Используй этот столбец, если нужно фильтровать данные по конкретному листу.\n"
+
+    sql_prompt += "Верни только SQL-запрос, ничего больше."
+    return sql_prompt
+
+
+def build_error_messages(messages, error):
+    """Дополняет сообщения для модели, когда сгенерированный SQL-запрос не удалось выполнить.
+
+    Список дополняется на месте, без копирования всей истории чата.
+    """
+    messages.append({"role": "assistant",
+                     "content": f"Я попытался выполнить SQL-запрос, но возникла ошибка: {error}. Могу я помочь с другим подходом?"})
+    return messages
+
+
+def build_summary_prompt(query, gpt_sql, result_df, sheet_names):
+    """Промпт для формулировки ответа на естественном языке по результату SQL-запроса."""
+    # Подготовим результат в читаемом виде: таблица с выровненными столбцами (ограничиваем до 10 строк)
+    result_str = "Результат запроса:\n"
+    result_str += result_df.head(10).to_string(index=False) + "\n"
+    if len(result_df) > 10:
+        result_str += f"... и еще {len(result_df) - 10} строк"
+
+    # Вместо сложного промпта с историей чата, используем прямой запрос на интерпретацию
+    summary_prompt = f"""
+Я выполнил SQL-запрос для вопроса "{query}" и получил следующий результат:
+
+SQL-запрос: {gpt_sql}
+
+{result_str}
+
+Пожалуйста, сформулируй информативный ответ на вопрос пользователя на основе этих данных.
+Пиши так, как будто напрямую отвечаешь на вопрос: "{query}"
+Не упоминай про SQL или запросы в своем ответе - просто дай фактический ответ на вопрос.
+"""
+    # Если результат пустой, добавляем информацию о многолистовой структуре
+    if len(result_df) == 0 and len(sheet_names) > 1:
+        summary_prompt += f"\nУчти, что Excel-файл содержит несколько листов: {', '.join(sheet_names)}. "
+        summary_prompt += "Возможно, нужная информация находится на одном из этих листов."
+    return summary_prompt
+
+
+def scalar_answer(query, result_df):
+    """Готовый ответ без обращения к модели, если запрос вернул одно значение (например, COUNT(*))."""
+    if result_df.shape != (1, 1):
+        return None
+    value = result_df.iat[0, 0]
+    if pd.isna(value):
+        value = "нет данных"
+    elif isinstance(value, float):
+        value = round(value, 2)
+    return f"{query.strip().rstrip('?').strip()}: {value}"
+
+
+def load_queries(queries_file):
+    """Читает вопросы из JSONL-файла: в каждой строке JSON-строка или объект с полем "query"."""
+    queries = []
+    with open(queries_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            queries.append(item['query'] if isinstance(item, dict) else str(item))
+    return queries
+
+
+async def wait_for_batch(client, batch_id):
+    """Ожидает завершения пакетного задания OpenAI Batch API."""
+    while True:
+        batch = await client.batches.retrieve(batch_id)
+        if batch.status in ('completed', 'failed', 'expired', 'cancelled'):
+            return batch
+        logger.info(f"Пакет {batch_id}: {batch.status}, ожидаю...")
+        await asyncio.sleep(BATCH_POLL_INTERVAL)
+
+
+async def chat_with_gpt_batch(client, model, message_lists, temperature=0):
+    """Отправляет набор запросов одним заданием OpenAI Batch API и возвращает ответы в исходном порядке.
+
+    Пакетные запросы стоят вдвое дешевле и не расходуют обычные лимиты, но выполняются
+    в фоне (до 24 часов), поэтому подходят только для офлайн-анализа.
+    """
+    lines = [
+        json.dumps({
+            "custom_id": f"q{i}",
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {"model": model, "messages": messages, "temperature": temperature}
+        }, ensure_ascii=False)
+        for i, messages in enumerate(message_lists)
+    ]
+    answers = ["Произошла ошибка при получении ответа: запрос не выполнен в пакетном режиме"] * len(lines)
+
+    try:
+        batch_input = await client.files.create(
+            file=("batch.jsonl", "\n".join(lines).encode('utf-8')),
+            purpose="batch"
+        )
+        batch = await client.batches.create(
+            input_file_id=batch_input.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        logger.info(f"Пакет {batch.id} отправлен ({len(lines)} запросов).")
+        batch = await wait_for_batch(client, batch.id)
+        if batch.status != 'completed' or not batch.output_file_id:
+            logger.info(f"Пакет {batch.id} завершился со статусом {batch.status}")
+            return answers
+
+        output = await client.files.content(batch.output_file_id)
+        for line in output.text.splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            response = item.get('response') or {}
+            if response.get('status_code') == 200:
+                answers[int(item['custom_id'][1:])] = response['body']['choices'][0]['message']['content']
+    except Exception as e:
+        logger.error(f"Ошибка при работе с OpenAI Batch API: {e}")
+    return answers
+
+
+def remove_temp_db(db_file):
+    """Удаляет временную базу данных."""
     try:
-        # Шаг 1: Загрузка Excel-файла в DataFrame
-        df = None
-        sheet_names = []
-
-        # Проверяем, есть ли файл в кэше и нужно ли его использовать
-        if args.cache and cache_key in file_cache and os.path.exists(db_file):
-            print(f"Используем кэшированные данные для файла {args.file_path}")
-            df = file_cache[cache_key]['dataframe']
-            sheet_names = file_cache[cache_key]['sheets']
+        os.remove(db_file)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning(f"Предупреждение: не удалось удалить временную базу данных: {e}")
+
+
+def create_client(api_key=None):
+    """Асинхронный клиент OpenAI с общим пулом соединений (ключ по умолчанию — из CHATGPT_API_KEY)."""
+    return AsyncOpenAI(
+        api_key=api_key or os.getenv("CHATGPT_API_KEY"),
+        http_client=DefaultAsyncHttpxClient(limits=httpx.Limits(max_connections=OPENAI_MAX_CONNECTIONS))
+    )
+
+
+class ExcelQA:
+    """Вопросы по данным одного Excel-файла.
+
+    Книга разбирается и загружается в SQLite (или в DuckDB в памяти) один раз при создании
+    объекта. Соединение (вместе с его кэшем подготовленных SQL-выражений), схема и примеры
+    строк живут между вопросами, поэтому долгоживущий процесс (бот) может задавать вопросы
+    без повторного запуска интерпретатора, импорта pandas и разбора файла.
+    """
+
+    table_name = TABLE_NAME  # Здесь всегда используем имя таблицы 'data'
+
+    def __init__(self, file_path, client, model="gpt-4", cache=False, cache_dir=DEFAULT_CACHE_DIR, engine='auto'):
+        self.file_path = file_path
+        self.client = client
+        self.model = model
+
+        # Движок SQL: небольшие книги DuckDB читает прямо из памяти, без записи базы на диск
+        self.engine = resolve_engine(engine, file_path, cache)
+        if self.engine == 'duckdb' and cache:
+            logger.info("База DuckDB хранится в памяти, дисковый кэш не используется.")
+            cache = False
+        self.cache = cache
+        self.sql_dialect = 'DuckDB' if self.engine == 'duckdb' else 'SQLite'
+
+        # Имя базы данных: при кэшировании база хранится на диске под хешем содержимого файла,
+        # поэтому переживает перезапуск скрипта и автоматически устаревает при изменении файла
+        if cache:
+            os.makedirs(cache_dir, exist_ok=True)
+            cache_name = f"{get_file_hash(file_path)}_v{CACHE_VERSION}"
+            self.db_file = os.path.join(cache_dir, f"{cache_name}.sqlite")
+            self.meta_file = os.path.join(cache_dir, f"{cache_name}.json")
         else:
+            self.db_file = f"temp_db_{os.path.basename(file_path).replace('.', '_')}.sqlite"
+            self.meta_file = None
+
+        self.conn = None
+        # Защищает соединение DuckDB от одновременных запросов из разных потоков
+        self.conn_lock = threading.Lock()
+        self.sheet_names = []
+        self.schema_str = None
+        self.examples_str = None
+        self._load()
+
+    def _load(self):
+        """Шаги 1-3: проверка кэша, загрузка книги в SQLite и извлечение схемы."""
+        # Шаг 1: Проверка дискового кэша
+        cache_hit = False
+        cached_meta = {}
+
+        # Проверяем, есть ли готовая база в дисковом кэше: сразу открываем файлы, отсутствие
+        # любого из них означает промах кэша
+        if self.cache:
             try:
-                # Получаем список всех листов в файле
-                excel_file = pd.ExcelFile(args.file_path)
-                sheet_names = excel_file.sheet_names
-                print(f"Файл содержит {len(sheet_names)} листов: {', '.join(sheet_names)}")
-
-                # Если листов несколько, обрабатываем каждый лист
-                all_dfs = []
-                for sheet_name in sheet_names:
-                    df_sheet = pd.read_excel(args.file_path, sheet_name=sheet_name)
-                    # Добавляем столбец с именем листа для отслеживания
-                    df_sheet['_sheet_name'] = sheet_name
-                    all_dfs.append(df_sheet)
-                    print(
-                        f"Лист '{sheet_name}' прочитан. Количество строк: {len(df_sheet)}, столбцов: {len(df_sheet.columns) - 1}")
-
-                # Объединяем все датафреймы в один, если их несколько
-                if len(all_dfs) > 1:
-                    df = pd.concat(all_dfs, ignore_index=True)
-                    print(f"Все листы объединены. Общее количество строк: {len(df)}, столбцов: {len(df.columns)}")
-                else:
-                    df = all_dfs[0]
-                    print(f"Файл успешно прочитан. Количество строк: {len(df)}, столбцов: {len(df.columns)}")
-
-                # Сохраняем в кэш, если включено кэширование
-                if args.cache:
-                    file_cache[cache_key] = {
-                        'dataframe': df,
-                        'sheets': sheet_names
-                    }
+                cached_meta = load_json_file(self.meta_file)
+                self.sheet_names = cached_meta['sheets']
+                self.conn = open_cached_db(self.db_file)
+                cache_hit = True
+                logger.info(f"Используем кэшированные данные для файла {self.file_path}")
+            except FileNotFoundError:
+                cached_meta = {}
             except Exception as e:
-                print(f"Ошибка при чтении файла Excel: {e}")
-                sys.exit(1)
+                # В том числе sqlite3.OperationalError, если самой базы нет
+                cached_meta = {}
+                logger.warning(f"Не удалось прочитать кэш, файл будет обработан заново: {e}")
 
-        # Шаг 2: Создание/перезапись таблицы в базе SQLite
+        # Шаг 2: Потоковая загрузка листов Excel в базу данных
         try:
+            if self.engine == 'duckdb':
+                self.conn = duckdb.connect()
+                self._import_workbook_duckdb(self.conn)
+                logger.info(f"Данные успешно загружены в DuckDB.")
             # Проверяем, нужно ли создавать базу данных заново
-            if not args.cache or not os.path.exists(db_file):
-                conn = sqlite3.connect(db_file)
-                df.to_sql(table_name, conn, if_exists='replace', index=False)
-                print(f"Данные успешно импортированы в SQLite.")
-            else:
-                conn = sqlite3.connect(db_file)
+            elif not cache_hit:
+                # Кэшируемую базу собираем во временном файле и публикуем атомарной заменой,
+                # чтобы параллельный запуск не увидел наполовину заполненную таблицу. Имя временного файла
+                # уникально для каждой сборки: pid у потоков одного процесса (бота) общий
+                build_file = unique_temp_path(self.db_file) if self.cache else self.db_file
+                conn = sqlite3.connect(build_file, check_same_thread=False)
+                try:
+                    conn.executescript(SQLITE_IMPORT_PRAGMAS)
+                    self._import_workbook(conn)
+                except Exception:
+                    conn.close()
+                    remove_temp_db(build_file)
+                    raise
+
+                if self.cache:
+                    # Кэшированная база дальше только читается: без WAL читателям не нужны файлы -wal/-shm
+                    conn.execute("PRAGMA journal_mode = DELETE")
+                    conn.close()
+                    os.replace(build_file, self.db_file)
+                    conn = open_cached_db(self.db_file)
+                logger.info(f"Данные успешно импортированы в SQLite.")
+                self.conn = conn
+        except FileNotFoundError:
+            raise
         except Exception as e:
-            print(f"Ошибка при работе с базой данных: {e}")
-            sys.exit(1)
+            raise RuntimeError(f"Ошибка при загрузке файла Excel в базу данных: {e}") from e
 
         # Шаг 3: Извлечение схемы таблицы и примеров строк
+        schema_str = cached_meta.get('schema_str')
+        examples_str = cached_meta.get('examples_str')
+        if schema_str is not None and examples_str is not None \
+                and cached_meta.get('checksum') == schema_checksum(schema_str, examples_str):
+            # Схема и примеры строк зависят только от содержимого файла, поэтому берём их из кэша
+            logger.info("Схема таблицы загружена из кэша.")
+        else:
+            try:
+                # Получаем информацию о столбцах через PRAGMA (DuckDB поддерживает её в том же виде)
+                columns_info = self.conn.execute(TABLE_INFO_SQL).fetchall()
+                # Формирование строкового описания схемы
+                schema_lines = []
+                for col in columns_info:
+                    col_name = col[1]
+                    col_type = col[2]
+                    schema_lines.append(f" - {col_name} ({col_type})")
+                schema_str = "\n".join(schema_lines)
+
+                # Получаем первые 5 строк из таблицы
+                rows = self.conn.execute(SAMPLE_ROWS_SQL).fetchall()
+                examples_str = rows_to_json(rows)
+            except Exception as e:
+                self.close()
+                raise RuntimeError(f"Ошибка при извлечении схемы таблицы: {e}") from e
+
+            # Сохраняем схему рядом с кэшированной базой, чтобы следующие запуски не обращались к SQLite
+            if self.cache:
+                try:
+                    write_cache_meta(self.meta_file, {
+                        'sheets': self.sheet_names,
+                        'schema_str': schema_str,
+                        'examples_str': examples_str,
+                        'checksum': schema_checksum(schema_str, examples_str)
+                    })
+                except Exception as e:
+                    logger.warning(f"Предупреждение: не удалось сохранить кэш схемы: {e}")
+
+        self.schema_str = schema_str
+        self.examples_str = examples_str
+
+    def _scan_workbook(self, wb):
+        """Первый проход по книге: заголовки, первая пачка строк и типы столбцов каждого листа."""
+        self.sheet_names = wb.sheetnames
+        logger.info(f"Файл содержит {len(self.sheet_names)} листов: {', '.join(self.sheet_names)}")
+
+        sheets = []
+        table_columns = {}  # имя столбца -> множество типов значений, в порядке появления
+        for sheet_name in self.sheet_names:
+            ws = wb[sheet_name]
+            header = next(ws.iter_rows(max_row=1, values_only=True), None)
+            if header is None:
+                logger.info(f"Лист '{sheet_name}' пуст и пропущен.")
+                continue
+            columns = sheet_columns(header)
+            rows = ws.iter_rows(min_row=2, max_col=len(columns), values_only=True)
+            first_batch = list(itertools.islice(rows, IMPORT_BATCH_SIZE))
+            for name, values in zip(columns, zip(*first_batch)):
+                table_columns.setdefault(name, set()).update(map(type, values))
+            for name in columns:
+                table_columns.setdefault(name, set())
+            sheets.append((sheet_name, columns, itertools.chain(first_batch, rows)))
+
+        if not sheets:
+            raise ValueError("в файле нет листов с данными")
+        return sheets, table_columns
+
+    def _import_workbook(self, conn):
+        """Построчно переносит все листы книги в таблицу SQLite, минуя DataFrame.
+
+        Строки из openpyxl (read_only) пачками по IMPORT_BATCH_SIZE уходят в executemany
+        внутри одной транзакции, поэтому в памяти не бывает полной копии данных.
+        Тип столбца определяется по первой пачке строк каждого листа.
+        """
+        # Открываем книгу один раз в потоковом режиме (read_only) и получаем список листов
+        wb = openpyxl.load_workbook(self.file_path, read_only=True, data_only=True)
         try:
-            cursor = conn.cursor()
-            # Получаем информацию о столбцах через PRAGMA
-            cursor.execute(f"PRAGMA table_info({table_name});")
-            columns_info = cursor.fetchall()
-            # Формирование строкового описания схемы
-            schema_lines = []
-            for col in columns_info:
-                col_name = col[1]
-                col_type = col[2]
-                schema_lines.append(f" - {col_name} ({col_type})")
-            schema_str = "\n".join(schema_lines)
-
-            # Получаем первые 5 строк из таблицы
-            cursor.execute(f"SELECT * FROM {table_name} LIMIT 5;")
-            rows = cursor.fetchall()
-            examples_str = "\n".join([str(row) for row in rows])
-        except Exception as e:
-            print(f"Ошибка при извлечении схемы таблицы: {e}")
-            conn.close()
-            sys.exit(1)
+            sheets, table_columns = self._scan_workbook(wb)
+
+            # Столбец с именем листа нужен, только если листов несколько
+            multi_sheet = len(sheets) > 1
+            column_defs = [f"{quote_identifier(name)} {column_type(types)}" for name, types in table_columns.items()]
+            if multi_sheet:
+                column_defs.append('"_sheet_name" TEXT')
+
+            total_rows = 0
+            # Загружаем все строки одной транзакцией, без fsync на каждую вставку
+            with conn:
+                conn.execute(f"DROP TABLE IF EXISTS {quote_identifier(self.table_name)}")
+                conn.execute(f"CREATE TABLE {quote_identifier(self.table_name)} ({', '.join(column_defs)})")
+
+                for sheet_name, columns, rows in sheets:
+                    # Имя листа подставляется в сам запрос, чтобы не дописывать его в каждую строку
+                    insert_columns = [quote_identifier(name) for name in columns]
+                    placeholders = ['?'] * len(columns)
+                    if multi_sheet:
+                        insert_columns.append('"_sheet_name"')
+                        placeholders.append("'" + sheet_name.replace("'", "''") + "'")
+                    insert_sql = (f"INSERT INTO {quote_identifier(self.table_name)} ({', '.join(insert_columns)}) "
+                                  f"VALUES ({', '.join(placeholders)})")
+
+                    rows = data_rows(rows, len(columns))
+                    sheet_rows = 0
+                    while batch := list(itertools.islice(rows, IMPORT_BATCH_SIZE)):
+                        conn.executemany(insert_sql, batch)
+                        sheet_rows += len(batch)
+
+                    total_rows += sheet_rows
+                    logger.info(f"Лист '{sheet_name}' прочитан. Количество строк: {sheet_rows}, столбцов: {len(columns)}")
+        finally:
+            wb.close()
+
+        self._print_import_summary(multi_sheet, total_rows, len(column_defs))
+
+    def _import_workbook_duckdb(self, conn):
+        """Загружает небольшую книгу в DuckDB: столбцы собираются в DataFrame,
+        который DuckDB читает напрямую, без записи базы на диск."""
+        wb = openpyxl.load_workbook(self.file_path, read_only=True, data_only=True)
+        try:
+            sheets, table_columns = self._scan_workbook(wb)
+            multi_sheet = len(sheets) > 1
+
+            data = {name: [] for name in table_columns}
+            sheet_name_values = []
+            total_rows = 0
+            for sheet_name, columns, rows in sheets:
+                sheet_rows = list(data_rows(rows, len(columns)))
+                for name, values in zip(columns, zip(*sheet_rows)):
+                    data[name].extend(values)
+                # Столбцы, которых нет на этом листе, заполняем пустыми значениями
+                for name in data.keys() - set(columns):
+                    data[name].extend([None] * len(sheet_rows))
+                if multi_sheet:
+                    sheet_name_values.extend([sheet_name] * len(sheet_rows))
+
+                total_rows += len(sheet_rows)
+                logger.info(f"Лист '{sheet_name}' прочитан. Количество строк: {len(sheet_rows)}, столбцов: {len(columns)}")
+        finally:
+            wb.close()
+
+        df = pd.DataFrame({name: duckdb_column(data.pop(name), column_type(types))
+                           for name, types in table_columns.items()})
+        if multi_sheet:
+            df['_sheet_name'] = sheet_name_values
+        conn.register(self.table_name, df)
+
+        self._print_import_summary(multi_sheet, total_rows, len(df.columns))
+
+    @staticmethod
+    def _print_import_summary(multi_sheet, total_rows, total_columns):
+        """Итоговое сообщение о загруженных данных."""
+        if multi_sheet:
+            logger.info(f"Все листы объединены. Общее количество строк: {total_rows}, столбцов: {total_columns}")
+        else:
+            logger.info(f"Файл успешно прочитан. Количество строк: {total_rows}, столбцов: {total_columns}")
+
+    def run_sql(self, sql):
+        """Выполняет SQL-запрос и возвращает результат в виде DataFrame.
+
+        Вызывается из потока (query и query_batch). Запросы к DuckDB выполняются по одному под conn_lock:
+        таблица — DataFrame, зарегистрированный в самом соединении, и курсоры DuckDB её не видят.
+        DuckDB и так распределяет один запрос по всем ядрам.
+        """
+        if self.engine == 'duckdb':
+            with self.conn_lock:
+                return self.conn.execute(sql).df()
+        return pd.read_sql_query(sql, self.conn)
+
+    def system_prompt(self):
+        """Системный промпт с описанием таблицы этого файла."""
+        return build_system_prompt(self.table_name, self.schema_str, self.examples_str, self.sheet_names,
+                                   self.sql_dialect)
+
+    async def query(self, query, chat_history=None):
+        """Шаги 4-7: отвечает на вопрос. Возвращает пару (ответ, успех)."""
+        chat_history = chat_history or []
 
         # Подготовка сообщений для модели
         messages = []
 
         # Добавляем системный промпт, если истории нет или начинаем новый чат
         if not chat_history or chat_history[0]["role"] != "system":
-            system_prompt = f"""Ты ассистент для анализа данных Excel. У меня есть таблица '{table_name}' в базе данных SQLite.
-Таблица '{table_name}' содержит столбцы:
-{schema_str}
-
-Примеры строк:
-{examples_str}
-
-Твоя задача - помогать анализировать данные из этой таблицы. 
-Отвечай на вопросы, генерируя SQL-запросы к данным, а затем объясняя результаты.
-Если нужно, используй подзапросы, группировку, объединения и другие SQL-конструкции для точного анализа.
-"""
-            # Добавляем информацию о структуре файла, если листов несколько
-            if len(sheet_names) > 1:
-                system_prompt += f"\nВажно: Excel-файл содержит {len(sheet_names)} листов: {', '.join(sheet_names)}.\n"
-                system_prompt += "Все данные из разных листов объединены в одну таблицу с дополнительным столбцом '_sheet_name', который указывает, из какого листа взята строка.\n"
-
-            messages.append({"role": "system", "content": system_prompt})
+            messages.append({"role": "system", "content": self.system_prompt()})
 
         # Добавляем историю чата, если она есть
         if chat_history:
@@ -198,123 +758,196 @@ def main():
                 messages.extend(chat_history)
 
         # Добавляем текущий вопрос пользователя, если его еще нет в истории
-        if not chat_history or chat_history[-1]["role"] != "user" or chat_history[-1]["content"] != args.query:
-            messages.append({"role": "user", "content": args.query})
-
-        # Шаг 4: Формирование промпта для генерации SQL
-        sql_prompt = f"""На основе предыдущей информации о таблице, напиши корректный SQL-запрос (SQLite) для ответа на вопрос: "{args.query}"
-Важно: 
-1. Таблица называется '{table_name}' (не используй другое имя таблицы).
-2. Если имя столбца содержит пробелы или специальные символы, оборачивай его в двойные кавычки.
-"""
-        # Добавляем информацию о многолистовой структуре, если нужно
-        if len(sheet_names) > 1:
-            sql_prompt += f"3. В таблице есть столбец '_sheet_name', который указывает, из какого листа Excel взята строка ({', '.join(sheet_names)}).\n"
-            sql_prompt += "   Используй этот столбец, если нужно фильтровать данные по конкретному листу.\n"
+        if not chat_history or chat_history[-1]["role"] != "user" or chat_history[-1]["content"] != query:
+            messages.append({"role": "user", "content": query})
 
-        sql_prompt += "Верни только SQL-запрос, ничего больше."
+        # Длинную историю сокращаем заранее, чтобы запрос не упал на превышении контекста модели
+        trim_messages(messages, self.model)
 
-        # Создаем временные сообщения с запросом на SQL
-        sql_messages = messages.copy()
-        sql_messages.append({"role": "user", "content": sql_prompt})
+        # Шаг 4: Формирование промпта для генерации SQL
+        sql_prompt = build_sql_prompt(query, self.table_name, self.sheet_names, self.sql_dialect)
 
-        print("Формирую SQL-запрос на основе вопроса...")
+        logger.info("Формирую SQL-запрос на основе вопроса...")
 
-        # Шаг 5: Вызов GPT для генерации SQL-запроса
+        # Шаг 5: Вызов GPT для генерации SQL-запроса. Запрос на SQL временно добавляется
+        # в конец сообщений и убирается после вызова, чтобы не копировать историю чата
+        messages.append({"role": "user", "content": sql_prompt})
         try:
-            gpt_sql = chat_with_gpt(client, args.model, sql_messages, temperature=0)
-            print("SQL-запрос сформирован.")
-        except Exception as e:
-            print(f"Ошибка при вызове GPT для генерации SQL: {e}")
-            conn.close()
-            sys.exit(1)
+            gpt_sql = await chat_with_gpt(self.client, self.model, messages, temperature=0)
+        finally:
+            messages.pop()
+        logger.info("SQL-запрос сформирован.")
 
         # Извлечем SQL-запрос, если он обернут в тройные кавычки или код
-        if "```sql" in gpt_sql and "```" in gpt_sql.split("```sql", 1)[1]:
-            gpt_sql = gpt_sql.split("```sql", 1)[1].split("```", 1)[0].strip()
-        elif "```" in gpt_sql and "```" in gpt_sql.split("```", 1)[1]:
-            gpt_sql = gpt_sql.split("```", 1)[1].split("```", 1)[0].strip()
+        gpt_sql = extract_sql(gpt_sql)
 
-        print(f"Итоговый SQL-запрос: {gpt_sql}")
+        logger.info(f"Итоговый SQL-запрос: {gpt_sql}")
 
         # Шаг 6: Выполнение сгенерированного SQL-запроса в базе данных
         try:
-            cursor.execute(gpt_sql)
-            query_result = cursor.fetchall()
-
-            # Получаем имена столбцов из результата запроса
-            column_names = [description[0] for description in cursor.description]
-            print(f"Запрос успешно выполнен. Получено строк: {len(query_result)}")
+            # Результат сразу собираем в DataFrame: строки и имена столбцов без построчной обработки в Python.
+            # Запрос выполняется в потоке, чтобы долгий SQL не останавливал цикл событий (в боте — всех пользователей)
+            result_df = await asyncio.to_thread(self.run_sql, gpt_sql)
+            logger.info(f"Запрос успешно выполнен. Получено строк: {len(result_df)}")
         except Exception as e:
-            print(f"Ошибка при выполнении SQL-запроса: {e}")
+            logger.error(f"Ошибка при выполнении SQL-запроса: {e}")
 
             # Даже при ошибке, пытаемся дать содержательный ответ
-            error_messages = messages.copy()
-            error_messages.append({"role": "assistant",
-                                   "content": f"Я попытался выполнить SQL-запрос, но возникла ошибка: {e}. Могу я помочь с другим подходом?"})
-
-            error_response = chat_with_gpt(client, args.model, error_messages, temperature=0.7)
-            print("\n=== РЕЗУЛЬТАТ ДЛЯ ПОЛЬЗОВАТЕЛЯ ===\n")
-            print(error_response)
+            error_messages = build_error_messages(messages, e)
+            error_response = await chat_with_gpt(self.client, self.model, error_messages, temperature=0.7)
+            return error_response, False
 
-            # Не закрываем соединение, если используется кэширование
-            if not args.cache:
-                conn.close()
-            sys.exit(1)
+        # Одно значение в ответе (количество, сумма, среднее) формулируем без второго вызова модели
+        answer = scalar_answer(query, result_df)
+        if answer is not None:
+            return answer, True
 
         # Шаг 7: Получение ответа от GPT на основе результата SQL
+        summary_prompt = build_summary_prompt(query, gpt_sql, result_df, self.sheet_names)
+
+        # Вызываем GPT для получения естественно-языкового ответа
+        natural_language_answer = await chat_with_gpt(self.client, self.model,
+                                                      [{"role": "user", "content": summary_prompt}],
+                                                      temperature=0.7)
+        return natural_language_answer, True
+
+    async def query_batch(self, queries):
+        """Отвечает на список вопросов через два пакетных задания: генерация SQL и формулировка ответов."""
+        system_prompt = self.system_prompt()
+
+        # Этап 1: SQL-запросы для всех вопросов одним пакетом
+        sql_requests = [
+            [{"role": "system", "content": system_prompt},
+             {"role": "user", "content": query},
+             {"role": "user", "content": build_sql_prompt(query, self.table_name, self.sheet_names, self.sql_dialect)}]
+            for query in queries
+        ]
+        logger.info(f"Формирую SQL-запросы для {len(queries)} вопросов в пакетном режиме...")
+        sql_responses = await chat_with_gpt_batch(self.client, self.model, sql_requests, temperature=0)
+
+        # Этап 2: выполняем запросы локально и готовим промпты для ответов;
+        # ответы из одного значения формулируются сразу, без модели
+        answers = [None] * len(queries)
+        answer_requests = []
+        for i, (query, sql_response) in enumerate(zip(queries, sql_responses)):
+            gpt_sql = extract_sql(sql_response)
+            try:
+                result_df = await asyncio.to_thread(self.run_sql, gpt_sql)
+                answers[i] = scalar_answer(query, result_df)
+                if answers[i] is None:
+                    summary_prompt = build_summary_prompt(query, gpt_sql, result_df, self.sheet_names)
+                    answer_requests.append([{"role": "user", "content": summary_prompt}])
+            except Exception as e:
+                logger.error(f"Ошибка при выполнении SQL-запроса для вопроса \"{query}\": {e}")
+                answer_requests.append(build_error_messages(
+                    [{"role": "system", "content": system_prompt}, {"role": "user", "content": query}], e))
+
+        if answer_requests:
+            logger.info("Формирую ответы в пакетном режиме...")
+            model_answers = iter(await chat_with_gpt_batch(self.client, self.model, answer_requests, temperature=0.7))
+            answers = [answer if answer is not None else next(model_answers) for answer in answers]
+        return answers
+
+    def close(self):
+        """Закрывает соединение и удаляет временную базу, если не используется кэширование."""
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+        if not self.cache:
+            remove_temp_db(self.db_file)
+
+
+async def main():
+    # Парсинг аргументов командной строки
+    parser = argparse.ArgumentParser(description='Ответ на вопросы по данным из Excel-файла')
+    parser.add_argument('file_path', help='Путь к Excel-файлу')
+    parser.add_argument('query', nargs='?', help='Вопрос пользователя')
+    parser.add_argument('--api_key', help='API ключ OpenAI (или будет использован из переменной окружения)')
+    parser.add_argument('--model', default="gpt-4", help='Модель OpenAI (по умолчанию: gpt-4)')
+    parser.add_argument('--chat-history', help='Путь к JSON-файлу с историей чата')
+    parser.add_argument('--cache', action='store_true', help='Использовать кэширование данных')
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR,
+                        help=f'Каталог для дискового кэша (по умолчанию: {DEFAULT_CACHE_DIR})')
+    parser.add_argument('--engine', choices=['auto', 'duckdb', 'sqlite'], default='auto',
+                        help='Движок SQL: auto — DuckDB в памяти для небольших файлов без --cache, иначе SQLite')
+    parser.add_argument('--queries-file',
+                        help='JSONL-файл со списком вопросов для пакетной обработки через OpenAI Batch API')
+
+    args = parser.parse_args()
+    # Ход работы выводим как раньше, простыми строками; журналы httpx и других библиотек не показываем
+    logger.addHandler(logging.StreamHandler(sys.stdout))
+    logger.setLevel(logging.INFO)
+    if not args.query and not args.queries_file:
+        parser.error('нужно указать вопрос или --queries-file')
+
+    # Загружаем историю чата, если она есть
+    chat_history = []
+    if args.chat_history:
         try:
-            # Подготовим результат в более читаемом виде
-            result_str = "Результат запроса:\n"
-            result_str += ", ".join(column_names) + "\n"
-            for row in query_result[:10]:  # Ограничиваем до 10 строк для ответа
-                result_str += str(row) + "\n"
-            if len(query_result) > 10:
-                result_str += f"... и еще {len(query_result) - 10} строк"
-
-            # Вместо сложного промпта с историей чата, используем прямой запрос на интерпретацию
-            summary_prompt = f"""
-Я выполнил SQL-запрос для вопроса "{args.query}" и получил следующий результат:
+            chat_history = load_json_file(args.chat_history)
+            print(f"История чата загружена из {args.chat_history}")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Ошибка при загрузке истории чата: {e}")
+            # Продолжаем с пустой историей
+            chat_history = []
 
-SQL-запрос: {gpt_sql}
+    # Загружаем список вопросов для пакетного режима
+    queries = []
+    if args.queries_file:
+        try:
+            queries = load_queries(args.queries_file)
+        except Exception as e:
+            print(f"Ошибка при чтении файла с вопросами: {e}")
+            sys.exit(1)
+        if not queries:
+            print(f"Файл с вопросами {args.queries_file} пуст.")
+            sys.exit(1)
 
-{result_str}
+    # Информация о запуске
+    print(f"Анализирую файл: {args.file_path}")
+    if queries:
+        print(f"Пакетный режим: {len(queries)} вопросов")
+    else:
+        print(f"Вопрос пользователя: {args.query}")
 
-Пожалуйста, сформулируй информативный ответ на вопрос пользователя на основе этих данных.
-Пиши так, как будто напрямую отвечаешь на вопрос: "{args.query}"
-Не упоминай про SQL или запросы в своем ответе - просто дай фактический ответ на вопрос.
-"""
-            # Если результат пустой, добавляем информацию о многолистовой структуре
-            if len(query_result) == 0 and len(sheet_names) > 1:
-                summary_prompt += f"\nУчти, что Excel-файл содержит несколько листов: {', '.join(sheet_names)}. "
-                summary_prompt += "Возможно, нужная информация находится на одном из этих листов."
+    # Создание асинхронного клиента OpenAI с общим пулом соединений
+    client = create_client()
+
+    try:
+        # Шаги 1-3: загрузка файла в SQLite и извлечение схемы
+        try:
+            qa = ExcelQA(args.file_path, client, model=args.model, cache=args.cache, cache_dir=args.cache_dir,
+                         engine=args.engine)
+        except FileNotFoundError:
+            # Существование файла не проверяем заранее: его первое открытие и есть проверка
+            print(f"Ошибка: файл {args.file_path} не найден.")
+            sys.exit(1)
+        except Exception as e:
+            print(e)
+            sys.exit(1)
+
+        try:
+            # Пакетный режим: все вопросы из файла обрабатываются через OpenAI Batch API
+            if queries:
+                answers = await qa.query_batch(queries)
+                print("\n=== РЕЗУЛЬТАТ ДЛЯ ПОЛЬЗОВАТЕЛЯ ===\n")
+                for query, answer in zip(queries, answers):
+                    print(f"Вопрос: {query}\n{answer}\n")
+                return
 
-            # Вызываем GPT для получения естественно-языкового ответа
-            natural_language_answer = chat_with_gpt(client, args.model, [{"role": "user", "content": summary_prompt}],
-                                                    temperature=0.7)
+            # Шаги 4-7: генерация SQL, выполнение и формулировка ответа
+            answer, success = await qa.query(args.query, chat_history)
 
             # Выводим ответ (это будет возвращено боту)
             print("\n=== РЕЗУЛЬТАТ ДЛЯ ПОЛЬЗОВАТЕЛЯ ===\n")
-            print(natural_language_answer)
-
-            # Добавляем ответ в историю, если она есть
-            if chat_history:
-                messages.append({"role": "assistant", "content": natural_language_answer})
-
-        except Exception as e:
-            print(f"Ошибка при получении естественного ответа от GPT: {e}")
+            print(answer)
+            if not success:
+                sys.exit(1)
         finally:
-            # Не закрываем соединение, если используется кэширование
-            if not args.cache:
-                conn.close()
-
-        # Шаг 8: Удаление временной базы данных только если не используется кэширование
-        if not args.cache:
-            try:
-                if os.path.exists(db_file):
-                    os.remove(db_file)
-            except Exception as e:
-                print(f"Предупреждение: не удалось удалить временную базу данных: {e}")
+            # Шаг 8: Закрытие соединения и удаление временной базы данных, если не используется кэширование
+            qa.close()
 
     except KeyboardInterrupt:
         print("Прерывание выполнения пользователем.")
@@ -325,4 +958,4 @@ SQL-запрос: {gpt_sql}
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    asyncio.run(main())
@@ -1,10 +1,42 @@
 import os
 import sys
+import json
+import re
 import pandas as pd
+import openpyxl
 import sqlite3
 import argparse
+import gc
 from openai import OpenAI
 
+try:
+    import orjson
+except ImportError:  # без orjson используем стандартный json
+    orjson = None
+
+# Настройки SQLite для быстрой массовой загрузки данных из Excel
+SQLITE_IMPORT_PRAGMAS = """
+PRAGMA journal_mode = WAL;
+PRAGMA synchronous = OFF;
+PRAGMA temp_store = MEMORY;
+PRAGMA cache_size = -262144;
+"""
+
+# Блок кода с SQL в ответе модели: ```sql ... ``` или просто ``` ... ```
+SQL_FENCE_RE = re.compile(r"```(?:sql)?[ \t]*\n?(.*?)```", re.DOTALL | re.IGNORECASE)
+
+
+def quote_identifier(name):
+    """Экранирует имя таблицы или столбца для подстановки в SQL."""
+    return '"' + name.replace('"', '""') + '"'
+
+
+# Имя таблицы с данными и постоянные тексты служебных запросов к ней: текст не собирается
+# заново при каждом вызове, поэтому SQLite берёт готовое выражение из кэша соединения
+TABLE_NAME = 'data'
+TABLE_INFO_SQL = f"PRAGMA table_info({quote_identifier(TABLE_NAME)})"
+SAMPLE_ROWS_SQL = f"SELECT * FROM {quote_identifier(TABLE_NAME)} LIMIT 5"
+
 
 def chat_with_gpt(client, model, user_content, temperature=0):
     """Удобная обёртка для вызова GPT через API."""
@@ -20,6 +52,48 @@ def chat_with_gpt(client, model, user_content, temperature=0):
         return f"Произошла ошибка при получении ответа: {e}"
 
 
+def extract_sql(response):
+    """Извлекает SQL-запрос из ответа модели, если он обёрнут в блок кода ```sql ... ```."""
+    match = SQL_FENCE_RE.search(response)
+    return (match.group(1) if match else response).strip()
+
+
+def rows_to_json(rows):
+    """Сериализует строки таблицы в JSON одним вызовом (даты и прочие значения — строками)."""
+    if orjson is not None:
+        return orjson.dumps(rows, default=str).decode('utf-8')
+    return json.dumps(rows, ensure_ascii=False, default=str)
+
+
+def read_sheet(ws):
+    """Потоково читает лист openpyxl (read_only) и строит DataFrame без промежуточного DOM."""
+    rows = ws.iter_rows(values_only=True)
+    header = next(rows, None)
+    if header is None:
+        return pd.DataFrame()
+
+    # Пустые заголовки и дубликаты называем так же, как это делает pd.read_excel
+    columns = []
+    seen = {}
+    for i, name in enumerate(header):
+        name = f"Unnamed: {i}" if name is None else name
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        columns.append(name)
+
+    width = len(columns)
+    data = [row[:width] for row in rows]
+    # В режиме read_only в конце листа часто остаются полностью пустые строки
+    while data and all(value is None for value in data[-1]):
+        data.pop()
+
+    # Типы столбцов (числа, даты, строки) pandas выводит по значениям ячеек
+    return pd.DataFrame(data, columns=columns)
+
+
 def main():
     # Парсинг аргументов командной строки
     parser = argparse.ArgumentParser(description='Ответ на вопросы по данным из Excel-файла')
@@ -49,12 +123,17 @@ def main():
 
     # Создание временного имени для базы данных
     db_file = f"temp_db_{os.path.basename(args.file_path).replace('.', '_')}.sqlite"
-    table_name = 'data'
+    table_name = TABLE_NAME
 
     try:
         # Шаг 1: Загрузка Excel-файла в DataFrame
         try:
-            df = pd.read_excel(args.file_path)
+            # Читаем первый лист в потоковом режиме (read_only), не строя DOM всей книги
+            wb = openpyxl.load_workbook(args.file_path, read_only=True, data_only=True)
+            try:
+                df = read_sheet(wb.worksheets[0])
+            finally:
+                wb.close()
             print(f"Файл успешно прочитан. Количество строк: {len(df)}, столбцов: {len(df.columns)}")
         except Exception as e:
             print(f"Ошибка при чтении файла Excel: {e}")
@@ -63,8 +142,14 @@ def main():
         # Шаг 2: Создание/перезапись таблицы в базе SQLite
         try:
             conn = sqlite3.connect(db_file)
-            df.to_sql(table_name, conn, if_exists='replace', index=False)
+            conn.executescript(SQLITE_IMPORT_PRAGMAS)
+            # Загружаем все строки одной транзакцией, без fsync на каждую вставку
+            with conn:
+                df.to_sql(table_name, conn, if_exists='replace', index=False, chunksize=10000)
             print(f"Данные успешно импортированы в SQLite.")
+            # Дальше данные читаются только из SQLite: освобождаем DataFrame до долгих запросов к модели
+            del df
+            gc.collect()
         except Exception as e:
             print(f"Ошибка при работе с базой данных: {e}")
             sys.exit(1)
@@ -73,7 +158,7 @@ def main():
         try:
             cursor = conn.cursor()
             # Получаем информацию о столбцах через PRAGMA
-            cursor.execute(f"PRAGMA table_info({table_name});")
+            cursor.execute(TABLE_INFO_SQL)
             columns_info = cursor.fetchall()
             # Формирование строкового описания схемы
             schema_lines = []
@@ -84,9 +169,9 @@ def main():
             schema_str = "\n".join(schema_lines)
 
             # Получаем первые 5 строк из таблицы
-            cursor.execute(f"SELECT * FROM {table_name} LIMIT 5;")
+            cursor.execute(SAMPLE_ROWS_SQL)
             rows = cursor.fetchall()
-            examples_str = "\n".join([str(row) for row in rows])
+            examples_str = rows_to_json(rows)
         except Exception as e:
             print(f"Ошибка при извлечении схемы таблицы: {e}")
             conn.close()
@@ -117,18 +202,12 @@ def main():
             sys.exit(1)
 
         # Извлечем SQL-запрос, если он обернут в тройные кавычки или код
-        if "```sql" in gpt_sql and "```" in gpt_sql.split("```sql", 1)[1]:
-            gpt_sql = gpt_sql.split("```sql", 1)[1].split("```", 1)[0].strip()
-        elif "```" in gpt_sql and "```" in gpt_sql.split("```", 1)[1]:
-            gpt_sql = gpt_sql.split("```", 1)[1].split("```", 1)[0].strip()
+        gpt_sql = extract_sql(gpt_sql)
 
         # Шаг 6: Выполнение сгенерированного SQL-запроса в базе данных
         try:
-            cursor.execute(gpt_sql)
-            query_result = cursor.fetchall()
-
-            # Получаем имена столбцов из результата запроса
-            column_names = [description[0] for description in cursor.description]
+            # Результат сразу собираем в DataFrame: строки и имена столбцов без построчной обработки в Python
+            result_df = pd.read_sql_query(gpt_sql, conn)
         except Exception as e:
             print(f"Ошибка при выполнении SQL-запроса: {e}")
             conn.close()
@@ -136,13 +215,11 @@ def main():
 
         # Шаг 7: Получение "живого" (естественного) ответа от GPT на основе результата SQL
         try:
-            # Подготовим результат в более читаемом виде
+            # Подготовим результат в читаемом виде: таблица с выровненными столбцами (ограничиваем до 10 строк)
             result_str = "Результат запроса:\n"
-            result_str += ", ".join(column_names) + "\n"
-            for row in query_result[:10]:  # Ограничиваем до 10 строк для ответа
-                result_str += str(row) + "\n"
-            if len(query_result) > 10:
-                result_str += f"... и еще {len(query_result) - 10} строк"
+            result_str += result_df.head(10).to_string(index=False) + "\n"
+            if len(result_df) > 10:
+                result_str += f"... и еще {len(result_df) - 10} строк"
 
             summary_prompt = f"""У меня есть результат выполнения SQL-запроса по вопросу "{args.query}".
 SQL-запрос: 
@@ -1,29 +1,166 @@
 import os
 import sys
 import json
+import re
+import numpy as np
 import pandas as pd
+import openpyxl
+import openpyxl.writer.excel
 import sqlite3
 import argparse
+import functools
 import hashlib
+import importlib
+import io
 import time
+import warnings
+import zipfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from openai import OpenAI
 from dotenv import load_dotenv
 
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    from adbc_driver_sqlite import dbapi as adbc_sqlite
+except ImportError:  # без pyarrow/ADBC данные загружаются через pandas.to_sql
+    pa = None
+    adbc_sqlite = None
+
+try:
+    import duckdb
+except ImportError:  # без duckdb данные хранятся и запрашиваются в SQLite
+    duckdb = None
+
+try:
+    import blake3
+except ImportError:  # без blake3 используем встроенный blake2b
+    blake3 = None
+
+try:
+    import python_calamine  # движок 'calamine' для pandas.read_excel
+    # Rust-парсер calamine читает xlsx в разы быстрее openpyxl, не создавая Python-объект на каждую ячейку
+    EXCEL_ENGINE = 'calamine'
+except ImportError:
+    EXCEL_ENGINE = 'openpyxl'
+
+try:
+    import xlsxwriter
+    import xlsxwriter.workbook
+except ImportError:  # без xlsxwriter итоговый файл пишется через openpyxl в режиме write_only
+    xlsxwriter = None
+
 load_dotenv()
 
-# Глобальный кэш для хранения обработанных файлов
-file_cache = {}
+# Модель для структурных ответов (план сводной таблицы в JSON): задача детерминированная,
+# поэтому хватает быстрой модели и нулевой температуры
+STRUCTURAL_MODEL = os.getenv('STRUCTURAL_MODEL', 'gpt-4o-mini')
+
+# Каталог кэша: готовые базы SQLite, названные по хешу содержимого Excel-файла
+DEFAULT_CACHE_DIR = '.excel_cache'
+
+# Сколько первых строк таблицы показывать модели как примеры значений столбцов
+SAMPLE_ROWS = 3
+
+# Сколько загруженных книг держать открытыми в одном процессе
+MAX_SESSIONS = 4
+# Загруженные книги: (хеш файла, движок) -> сессия, от давно использованной к недавней
+SESSIONS = OrderedDict()
+# Оставлять ли книгу открытой в SESSIONS после запроса. Одноразовый запуск скрипта закрывает базу в конце main();
+# долгоживущий процесс (table_worker.py) включает этот флаг, и повторный запрос к той же книге не открывает
+# базу и не читает схему заново
+KEEP_SESSIONS = False
+
+# Ошибки выполнения SQL-запроса в любом из движков
+SQL_ERRORS = (sqlite3.OperationalError, duckdb.Error) if duckdb is not None else (sqlite3.OperationalError,)
+
+# Можно ли выполнять запрос через ADBC: его драйвер для SQLite не отменяет запрос, и после таймаута поток
+# продолжает работать до конца запроса. В одноразовом запуске скрипта это безразлично, а долгоживущий
+# процесс (table_worker.py) выключает ADBC, чтобы зависший запрос не занимал ядро и соединение навсегда
+ADBC_QUERIES = True
+# Как часто (в инструкциях виртуальной машины SQLite) проверяется таймаут выполняющегося запроса
+SQLITE_PROGRESS_STEPS = 10000
+# Сколько строк результата за раз забирается из курсора sqlite3 и переводится в DataFrame
+SQLITE_FETCH_ROWS = 100000
+
+# Кэш ответов модели на вспомогательные промпты (уточнение, план сводной таблицы, описание) в каталоге кэша
+PROMPT_CACHE_FILE = 'prompt_cache.sqlite'
+# Ограничения размера кэша: при записи новой записи удаляются давно не использованные (по времени изменения
+# файла; при попадании в кэш оно обновляется), а в кэше ответов модели — самые старые ответы
+CACHE_MAX_TABLES = 20
+CACHE_MAX_RESULTS = 500
+PROMPT_CACHE_MAX_ROWS = 10000
+# Начало текста, который chat_with_gpt возвращает вместо ответа при ошибке API: такие ответы не кэшируются
+CHAT_ERROR_PREFIX = "Произошла ошибка при получении ответа"
+
+# Объём файла кэшированной базы, отображаемый в память: страницы читаются из кэша ОС без копирования
+SQLITE_MMAP_SIZE = 1024 * 1024 * 1024
+
+# Сколько строк результата за раз переводится в объекты Python при записи листа через xlsxwriter
+EXCEL_WRITE_CHUNK_ROWS = 10000
+
+# Уровень сжатия zip-архива итогового xlsx. По умолчанию zlib сжимает с уровнем 6, и на больших листах
+# упаковка файла занимает до трети времени записи; уровень 1 в несколько раз быстрее ценой чуть большего файла.
+# Ни xlsxwriter, ни openpyxl не дают задать уровень, поэтому на время сохранения файла ZipFile в их модуле
+# упаковки подменяется (см. zip_compresslevel)
+EXCEL_ZIP_COMPRESSLEVEL = 1
+
+
+# Блок кода с SQL в ответе модели: ```sql ... ``` или просто ``` ... ```
+SQL_FENCE_RE = re.compile(r"```(?:sql)?[ \t]*\n?(.*?)```", re.DOTALL | re.IGNORECASE)
+
+# Строки описания схемы вида " - Имя столбца (ТИП)"; вся схема разбирается одним проходом регулярного выражения
+SCHEMA_LINE_RE = re.compile(r"^ - (.+) \(([^()\n]*)\)$", re.MULTILINE)
+# Столбец с датой: тип даты (TIMESTAMP в SQLite; TIMESTAMP_NS, DATE в DuckDB) или слово «дата» в имени
+DATE_TYPE_RE = re.compile(r"TIMESTAMP|DATE")
+DATE_NAME_RE = re.compile(r"Date|(?i:дата)")
+
+# Сколько столбцов результата перечислять в промптах и сколько из них показывать в примерах строк:
+# на таблицах в сотни столбцов полный список раздувает промпт и замедляет ответ модели
+PROMPT_MAX_COLUMNS = 30
+PROMPT_HEAD_COLUMNS = 10
+
+# Промпты, общие для выполнения готового SQL (--execute-sql) и полного цикла: один текст на оба пути,
+# поэтому одинаковые данные дают один и тот же ключ в кэше ответов модели
+EMPTY_RESULT_PROMPT = """Запрос:
+{sql_query}
+
+Результат пустой. Возможно, не нашлось данных, удовлетворяющих условиям.
+Сформулируй уточняющий вопрос или возможную причину, почему нет данных. Также предложи, как можно изменить запрос, чтобы получить результаты."""
+
+DESCRIPTION_PROMPT = """
+Я создал таблицу по запросу пользователя: "{query}"
+
+Получилась таблица размером {n_rows} строк на {n_cols} столбцов.
+Столбцы таблицы: {col_list}
+
+Первые 5 строк таблицы:
+{head_rows}
+
+Опиши кратко (2-3 предложения), что представляет собой эта таблица и какую информацию она содержит.
+"""
+
+PIVOT_PLAN_PROMPT = """
+На основе запроса пользователя: "{query}"
+И структуры результирующей таблицы с {n_rows} строками и столбцами: {col_list}
+
+Определи:
+1. Какой столбец лучше всего использовать для группировки данных в сводной таблице?
+2. Какое агрегирование следует применить: sum (сумма), mean (среднее) или count (количество)?
+3. Какие столбцы стоит вывести в качестве значений?
+
+Верни только JSON-объект вида {{"group_by": "столбец", "agg": "sum", "values": ["столбец", ...]}}.
+"""
 
 
 def generate_sql_for_date_filters(sql_prompt, schema_str):
     """Добавляет подсказки для работы с датами в SQL-запросах"""
     # Проверяем наличие столбцов с датами в схеме
-    date_columns = []
-    for line in schema_str.split('\n'):
-        if '(TIMESTAMP)' in line or 'Date' in line or 'дата' in line.lower() or 'Дата' in line:
-            col_name = line.split(' - ')[1].split(' (')[0]
-            date_columns.append(col_name)
+    date_columns = [col_name for col_name, col_type in SCHEMA_LINE_RE.findall(schema_str)
+                    if DATE_TYPE_RE.match(col_type) or DATE_NAME_RE.search(col_name)]
 
     if date_columns:
         date_hint = f"""
@@ -39,39 +176,781 @@ def generate_sql_for_date_filters(sql_prompt, schema_str):
     return sql_prompt
 
 
-def chat_with_gpt(client, model, user_content, temperature=0):
-    """Удобная обёртка для вызова GPT через API."""
+def chat_with_gpt(client, model, user_content, temperature=0, response_format=None):
+    """Удобная обёртка для вызова GPT через API.
+
+    response_format передаётся в API как есть, например {"type": "json_object"} для ответа в JSON.
+    """
+    # Если передан список сообщений (для поддержки истории), иначе — просто строковый запрос
+    messages = user_content if isinstance(user_content, list) else [{"role": "user", "content": user_content}]
+    extra = {'response_format': response_format} if response_format is not None else {}
     try:
-        # Если передан список сообщений (для поддержки истории)
-        if isinstance(user_content, list):
-            response = client.chat.completions.create(
-                model=model,
-                messages=user_content,
-                temperature=temperature
-            )
-        else:
-            # Если передан просто строковый запрос
-            response = client.chat.completions.create(
-                model=model,
-                messages=[{"role": "user", "content": user_content}],
-                temperature=temperature
-            )
+        response = client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            **extra
+        )
         return response.choices[0].message.content
     except Exception as e:
         print(f"Ошибка при вызове API OpenAI: {e}")
-        return f"Произошла ошибка при получении ответа: {e}"
+        return f"{CHAT_ERROR_PREFIX}: {e}"
+
+
+def cached_chat(client, model, prompt, temperature=0, cache_dir=None, response_format=None):
+    """chat_with_gpt с кэшем ответов в SQLite: повторный такой же промпт не идёт в API.
+
+    Ключ — SHA-256 от модели, температуры и текста промпта. Без cache_dir кэш не используется.
+    """
+    if cache_dir is None:
+        return chat_with_gpt(client, model, prompt, temperature, response_format)
+
+    key = hashlib.sha256(f"{model}\0{round(temperature, 2)}\0{prompt}".encode('utf-8')).hexdigest()
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        cache = sqlite3.connect(os.path.join(cache_dir, PROMPT_CACHE_FILE), timeout=30)
+        cache.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT NOT NULL)")
+    except sqlite3.Error as e:
+        print(f"Предупреждение: кэш ответов недоступен: {e}")
+        return chat_with_gpt(client, model, prompt, temperature, response_format)
+
+    try:
+        row = cache.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            return row[0]
+
+        response = chat_with_gpt(client, model, prompt, temperature, response_format)
+        if not response.startswith(CHAT_ERROR_PREFIX):
+            with cache:
+                cache.execute("INSERT OR REPLACE INTO responses (key, response) VALUES (?, ?)", (key, response))
+                # Новая запись получает наибольший rowid: оставляем PROMPT_CACHE_MAX_ROWS последних ответов
+                cache.execute("DELETE FROM responses WHERE rowid <= (SELECT MAX(rowid) FROM responses) - ?",
+                              (PROMPT_CACHE_MAX_ROWS,))
+        return response
+    finally:
+        cache.close()
+
+
+def extract_sql(response):
+    """Извлекает SQL-запрос из ответа модели, если он обёрнут в блок кода ```sql ... ```."""
+    match = SQL_FENCE_RE.search(response)
+    return (match.group(1) if match else response).strip()
+
+
+def head_rows_json(df, rows=5):
+    """Первые строки DataFrame в виде JSON-списка записей для промпта (даты и прочие значения — строками).
+
+    Берутся только первые PROMPT_HEAD_COLUMNS столбцов, чтобы широкая таблица не раздувала промпт.
+    """
+    head = df.iloc[:rows, :PROMPT_HEAD_COLUMNS]
+    return json.dumps(head.to_dict(orient="records"), ensure_ascii=False, default=str)
+
+
+def summarize_columns(columns, limit=PROMPT_MAX_COLUMNS):
+    """Список столбцов для промпта: первые limit имён через запятую и число остальных."""
+    names = ', '.join(str(name) for name in columns[:limit])
+    if len(columns) > limit:
+        names += f" ... (и ещё {len(columns) - limit})"
+    return names
+
+
+def start_chat_with_gpt(client, model, user_content, temperature=0, cache_dir=None, response_format=None):
+    """Отправляет запрос к GPT в фоновом потоке и сразу возвращает Future с ответом.
+
+    Так ответ на независимый запрос (описание таблицы) готовится, пока сохраняется Excel-файл
+    и выполняется запрос плана сводной таблицы, а не после них.
+    """
+    executor = ThreadPoolExecutor(max_workers=1)
+    future = executor.submit(cached_chat, client, model, user_content, temperature, cache_dir, response_format)
+    executor.shutdown(wait=False)
+    return future
 
 
 def get_file_hash(file_path):
     """Генерирует хеш файла для проверки изменений."""
-    h = hashlib.md5()
+    if blake3 is not None:
+        # BLAKE3 хеширует отображённый в память файл параллельно (SIMD), без цикла чтения в Python
+        return blake3.blake3(max_threads=blake3.blake3.AUTO).update_mmap(file_path).hexdigest()
     with open(file_path, 'rb') as file:
-        for chunk in iter(lambda: file.read(4096), b''):
-            h.update(chunk)
-    return h.hexdigest()
+        return hashlib.file_digest(file, 'blake2b').hexdigest()
+
+
+def resolve_engine(engine):
+    """Выбирает движок SQL: в режиме auto — DuckDB, если пакет установлен, иначе SQLite."""
+    if engine == 'auto':
+        return 'duckdb' if duckdb is not None else 'sqlite'
+    if engine == 'duckdb' and duckdb is None:
+        print("Предупреждение: пакет duckdb не установлен, используется SQLite.")
+        return 'sqlite'
+    return engine
+
+
+def open_database(db_file, timeout, cached, engine='sqlite'):
+    """Подключается к базе: готовую базу из кэша только читаем, новую настраиваем на быструю загрузку."""
+    if engine == 'duckdb':
+        # DuckDB сам распределяет сканирование и агрегаты по ядрам; файловых PRAGMA SQLite ему не нужно
+        return duckdb.connect(db_file, read_only=cached)
+
+    conn = sqlite3.connect(db_file, timeout=timeout)
+    # Увеличиваем таймаут для больших запросов - исправленная версия
+    conn.execute(f"PRAGMA busy_timeout = {timeout * 1000}")  # Исправлено: убраны скобки ?
+    if cached:
+        # Готовая база только читается: отображаем её в память вместо чтения страниц через буфер
+        conn.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE}")
+    else:
+        # Оптимизируем память и скорость
+        conn.execute("PRAGMA synchronous = OFF")
+        conn.execute("PRAGMA journal_mode = MEMORY")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        conn.execute("PRAGMA cache_size = 10000")
+    return conn
+
+
+def discard_build_file(conn, build_file, db_file):
+    """Удаляет недостроенную базу кэша после ошибки импорта."""
+    if build_file == db_file:
+        return
+    conn.close()
+    # DuckDB держит рядом с базой журнал .wal
+    for path in (build_file, f"{build_file}.wal"):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def sqlite_column_type(dtype):
+    """Тип столбца SQLite для типа столбца pandas — тот же, что выбирает pandas.to_sql."""
+    if pd.api.types.is_bool_dtype(dtype) or pd.api.types.is_integer_dtype(dtype):
+        return 'INTEGER'
+    if pd.api.types.is_float_dtype(dtype):
+        return 'REAL'
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        return 'TIMESTAMP'
+    return 'TEXT'
+
+
+def add_table_columns(conn, table_name, column_types, known_columns):
+    """Создаёт таблицу по столбцам первого листа, а для следующих листов добавляет недостающие столбцы.
+
+    Листы книги могут отличаться набором столбцов: в общей таблице они объединяются, как при pd.concat.
+    """
+    column_defs = ['"{}" {}'.format(name.replace('"', '""'), sql_type)
+                   for name, sql_type in column_types if name not in known_columns]
+    if not known_columns:
+        conn.execute(f'DROP TABLE IF EXISTS "{table_name}"')
+        conn.execute(f'CREATE TABLE "{table_name}" ({", ".join(column_defs)})')
+    else:
+        for column_def in column_defs:
+            conn.execute(f'ALTER TABLE "{table_name}" ADD COLUMN {column_def}')
+    known_columns.update(name for name, _ in column_types)
+
+
+def append_sheet_adbc(adbc_conn, df, table_name, sheet_name):
+    """Дописывает лист в таблицу колоночно: через таблицу Arrow и драйвер ADBC, без обхода строк в Python."""
+    table = pa.Table.from_pandas(df, preserve_index=False)
+
+    for i, field in enumerate(table.schema):
+        if pa.types.is_timestamp(field.type) or pa.types.is_date(field.type):
+            # Даты храним строками вида '2024-01-31 00:00:00', как pandas.to_sql
+            seconds = pc.cast(table.column(i), pa.timestamp('s'), safe=False)
+            table = table.set_column(i, field.name, pc.strftime(seconds, format='%Y-%m-%d %H:%M:%S'))
+        elif pa.types.is_string(field.type):
+            # Часто повторяющиеся строки (район, тип и т.п.) кодируем словарём: драйверу передаются индексы
+            # и короткий список уникальных значений вместо копии строки на каждую запись
+            column = table.column(i)
+            if pc.count_distinct(column).as_py() < len(column) // 4:
+                table = table.set_column(i, field.name, column.dictionary_encode())
+
+    # Имя листа — словарный столбец из одного значения: на строку приходится байт индекса, а не копия строки
+    indices = pa.array(np.zeros(len(table), dtype=np.int8))
+    table = table.append_column('_sheet_name', pa.DictionaryArray.from_arrays(indices, pa.array([sheet_name])))
+
+    try:
+        with adbc_conn.cursor() as cursor:
+            cursor.adbc_ingest(table_name, table, mode="append")
+        adbc_conn.commit()
+    except Exception:
+        adbc_conn.rollback()
+        raise
+
+
+def append_sheet_duckdb(conn, df, table_name, sheet_name, first_sheet):
+    """Дописывает лист в таблицу DuckDB.
+
+    Столбцы сопоставляются по именам (INSERT BY NAME): новые столбцы листа добавляются в таблицу через
+    ALTER TABLE, а столбец, в котором на разных листах разные типы, приводится к общему типу, как в
+    UNION ALL BY NAME. Уже загруженные строки при этом не переписываются заново на каждый лист.
+    """
+    df.columns = [str(name) for name in df.columns]
+    for name in df.columns[df.dtypes == object]:
+        # В столбце со значениями разных типов (числа вперемешку с текстом) храним текст
+        values = df[name]
+        df[name] = values.astype(str).where(values.notna(), None)
+
+    sheet_literal = "'" + sheet_name.replace("'", "''") + "'"
+    conn.register('sheet_df', df)
+    try:
+        if first_sheet:
+            conn.execute(f'DROP TABLE IF EXISTS "{table_name}"')
+            conn.execute(f'CREATE TABLE "{table_name}" AS '
+                         f'SELECT *, {sheet_literal} AS _sheet_name FROM sheet_df')
+            return
+
+        table_types = {row[0]: row[1] for row in conn.execute(f'DESCRIBE "{table_name}"').fetchall()}
+        for name, sheet_type, *_ in conn.execute('DESCRIBE SELECT * FROM sheet_df').fetchall():
+            column = '"{}"'.format(name.replace('"', '""'))
+            table_type = table_types.get(name)
+            if table_type is None:
+                conn.execute(f'ALTER TABLE "{table_name}" ADD COLUMN {column} {sheet_type}')
+            elif table_type != sheet_type:
+                # Общий тип двух столбцов DuckDB выводит так же, как для UNION ALL
+                common_type = conn.execute(
+                    f'DESCRIBE SELECT NULL::{table_type} AS c UNION ALL SELECT NULL::{sheet_type}').fetchone()[1]
+                if common_type != table_type:
+                    conn.execute(f'ALTER TABLE "{table_name}" ALTER {column} TYPE {common_type}')
+        conn.execute(f'INSERT INTO "{table_name}" BY NAME '
+                     f'SELECT *, {sheet_literal} AS _sheet_name FROM sheet_df')
+    finally:
+        conn.unregister('sheet_df')
+
+
+def fetch_query_result(conn, db_file, sql_query, timeout, engine='sqlite'):
+    """Выполняет SQL-запрос и возвращает результат в виде DataFrame.
+
+    Через ADBC результат приходит из SQLite колоночными буферами Arrow, без кортежа и словаря на каждую строку.
+    Драйвер ADBC для SQLite не умеет отменять запрос, поэтому он выполняется в фоновом потоке, который после
+    таймаута больше не ждём. Если ADBC не справился (например, в столбце результата значения разных типов),
+    запрос повторяется через sqlite3: там его прерывает сама SQLite через обработчик прогресса.
+    """
+    if engine == 'duckdb':
+        # DuckDB выполняет запрос векторно и сразу отдаёт колоночный результат; таймер прерывает запрос
+        timer = threading.Timer(timeout, conn.interrupt)
+        timer.start()
+        try:
+            return conn.execute(sql_query).df()
+        except duckdb.InterruptException:
+            raise sqlite3.OperationalError(f"timeout: запрос выполняется дольше {timeout} сек")
+        finally:
+            timer.cancel()
+
+    if adbc_sqlite is not None and ADBC_QUERIES:
+        result = {}
+
+        def run_adbc():
+            try:
+                with adbc_sqlite.connect(db_file) as adbc_conn:
+                    with adbc_conn.cursor() as cursor:
+                        cursor.execute(sql_query)
+                        result['table'] = cursor.fetch_arrow_table()
+            except Exception as e:
+                result['error'] = e
+
+        worker = threading.Thread(target=run_adbc, daemon=True)
+        worker.start()
+        worker.join(timeout)
+        if worker.is_alive():
+            raise sqlite3.OperationalError(f"timeout: запрос выполняется дольше {timeout} сек")
+        if 'table' in result:
+            return result['table'].to_pandas()
+
+    # Запасной путь: обычный курсор sqlite3. Строки забираются пачками по SQLITE_FETCH_ROWS и сразу переводятся
+    # в DataFrame, поэтому кортежи Python одновременно существуют только для одной пачки, а не для всего результата.
+    # Время проверяет сама SQLite: обработчик прогресса вызывается каждые SQLITE_PROGRESS_STEPS инструкций
+    # виртуальной машины и прерывает запрос после таймаута, без опроса из цикла Python и без отдельного потока.
+    # Отсчёт по монотонным часам: перевод системного времени не сдвигает таймаут
+    deadline = time.monotonic() + timeout
+    conn.set_progress_handler(lambda: time.monotonic() > deadline, SQLITE_PROGRESS_STEPS)
+    try:
+        cursor = conn.execute(sql_query)
+        columns = [description[0] for description in cursor.description]
+        frames = []
+        while True:
+            rows = cursor.fetchmany(SQLITE_FETCH_ROWS)
+            if not rows:
+                break
+            frames.append(pd.DataFrame.from_records(rows, columns=columns))
+        if not frames:
+            return pd.DataFrame(columns=columns)
+        # Пачка, где столбец целиком пустой, получает тип object; infer_objects после склейки возвращает
+        # столбцу тот тип, который был бы выведен по всему результату сразу
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', FutureWarning)
+            return pd.concat(frames, ignore_index=True).infer_objects()
+    except sqlite3.OperationalError:
+        if time.monotonic() > deadline:
+            raise sqlite3.OperationalError(f"timeout: запрос выполняется дольше {timeout} сек")
+        raise
+    finally:
+        conn.set_progress_handler(None, 0)
+
+
+def result_cache_path(cache_dir, file_hash, engine, sql_query):
+    """Путь к файлу Parquet с результатом запроса в кэше или None, если кэш выключен или нет pyarrow.
+
+    Ключ учитывает содержимое Excel-файла и движок: после изменения файла старый результат не используется.
+    """
+    if cache_dir is None or pa is None:
+        return None
+    key = hashlib.sha1(f"{file_hash}\0{engine}\0{sql_query}".encode('utf-8')).hexdigest()[:16]
+    return os.path.join(cache_dir, f"result_{key}.parquet")
+
+
+def touch_cache_file(path):
+    """Отмечает файл кэша как недавно использованный, чтобы evict_cache_files удалил его позже других."""
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def evict_cache_files(cache_dir, prefix, suffixes, keep, companions=(), exclude=()):
+    """Оставляет в cache_dir не больше keep файлов вида prefix*suffix, удаляя давно не использованные.
+
+    Вместе с файлом удаляются его спутники (путь файла плюс окончание из companions). Файлы из exclude
+    (например, открытые базы) не удаляются.
+    """
+    try:
+        entries = sorted((entry for entry in os.scandir(cache_dir)
+                          if entry.name.startswith(prefix) and entry.name.endswith(suffixes)),
+                         key=lambda entry: entry.stat().st_mtime, reverse=True)
+    except OSError:
+        return
+    for entry in entries[keep:]:
+        if entry.path in exclude:
+            continue
+        for path in (entry.path, *(entry.path + companion for companion in companions)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"Предупреждение: не удалось удалить старый файл кэша {path}: {e}")
+
+
+def cached_query_result(conn, db_file, sql_query, timeout, engine, cache_file):
+    """fetch_query_result с кэшем результата в Parquet: повторный такой же запрос не выполняется заново.
+
+    В кэше хранится не больше CACHE_MAX_RESULTS результатов.
+    """
+    if cache_file is not None and os.path.exists(cache_file):
+        try:
+            df = pd.read_parquet(cache_file)
+            touch_cache_file(cache_file)
+            print("Результат запроса взят из кэша.")
+            return df
+        except Exception as e:
+            print(f"Предупреждение: не удалось прочитать кэш результата: {e}")
+
+    df = fetch_query_result(conn, db_file, sql_query, timeout, engine)
+
+    if cache_file is not None:
+        # Пишем во временный файл и переименовываем: параллельный запуск не прочитает недописанный файл
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+        try:
+            df.to_parquet(tmp_file, compression='zstd', index=False)
+            os.replace(tmp_file, cache_file)
+            evict_cache_files(os.path.dirname(cache_file), 'result_', '.parquet', CACHE_MAX_RESULTS)
+        except Exception as e:
+            # Например, одинаковые имена столбцов или значения разных типов в одном столбце
+            print(f"Предупреждение: результат запроса не сохранён в кэш: {e}")
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+    return df
+
+
+@contextmanager
+def zip_compresslevel(module, compresslevel):
+    """На время блока with подменяет ZipFile в модуле на ZipFile с заданным уровнем сжатия.
+
+    Подмена действует только пока сохраняется итоговый файл: остальной код процесса (в том числе
+    следующие задания table_worker.py) работает с исходным ZipFile.
+    """
+    original = module.ZipFile
+    module.ZipFile = functools.partial(original, compresslevel=compresslevel)
+    try:
+        yield
+    finally:
+        module.ZipFile = original
+
+
+@contextmanager
+def open_excel_writer(output_file):
+    """Открывает итоговый Excel-файл на запись; файл сохраняется при выходе из блока with.
+
+    xlsxwriter в режиме constant_memory сбрасывает каждую строку в файл сразу после записи и не хранит
+    ячейки листа в памяти. Без xlsxwriter используется openpyxl в режиме write_only: строки тоже пишутся
+    потоком, без объекта на каждую ячейку, как в pandas.to_excel.
+    """
+    if xlsxwriter is not None:
+        # Архив упаковывается при закрытии книги, поэтому уровень сжатия задаём вокруг всего блока
+        with zip_compresslevel(xlsxwriter.workbook, EXCEL_ZIP_COMPRESSLEVEL), xlsxwriter.Workbook(output_file, {
+            'constant_memory': True,
+            'default_date_format': 'yyyy-mm-dd hh:mm:ss',
+            'strings_to_formulas': False,
+            'strings_to_urls': False,
+        }) as workbook:
+            yield workbook
+    else:
+        workbook = openpyxl.Workbook(write_only=True)
+        yield workbook
+        with zip_compresslevel(openpyxl.writer.excel, EXCEL_ZIP_COMPRESSLEVEL):
+            workbook.save(output_file)
+
+
+def iter_excel_rows(df):
+    """Строки DataFrame кортежами значений Python; пропуски (NaN, NaT) — None, такие ячейки остаются пустыми.
+
+    В объекты Python переводим по EXCEL_WRITE_CHUNK_ROWS строк, чтобы не держать в памяти объектную копию
+    всего результата.
+    """
+    for start in range(0, len(df), EXCEL_WRITE_CHUNK_ROWS):
+        chunk = df.iloc[start:start + EXCEL_WRITE_CHUNK_ROWS]
+        values = chunk.astype(object).where(chunk.notna(), None)
+        yield from values.itertuples(index=False, name=None)
+
+
+def write_excel_sheet(writer, df, sheet_name):
+    """Записывает DataFrame на новый лист итогового файла строка за строкой.
+
+    pandas.to_excel пишет ячейки по столбцам, а потоковые режимы обоих движков принимают строки только
+    по порядку, поэтому лист заполняем сами.
+    """
+    header = [str(column) for column in df.columns]
+
+    if isinstance(writer, openpyxl.Workbook):
+        worksheet = writer.create_sheet(sheet_name)
+        header_cells = []
+        for name in header:
+            cell = openpyxl.cell.WriteOnlyCell(worksheet, value=name)
+            cell.font = openpyxl.styles.Font(bold=True)
+            header_cells.append(cell)
+        worksheet.append(header_cells)
+        for row in iter_excel_rows(df):
+            worksheet.append(row)
+        return
+
+    worksheet = writer.add_worksheet(sheet_name)
+    header_format = writer.add_format({'bold': True, 'border': 1, 'align': 'center'})
+    worksheet.write_row(0, 0, header, header_format)
+    for row_number, row in enumerate(iter_excel_rows(df), start=1):
+        worksheet.write_row(row_number, 0, row)
+
+
+def infer_pivot_spec(df):
+    """Выбирает группировку и агрегирование для сводной таблицы по типам столбцов, без запроса к модели.
+
+    Группируем по нечисловому столбцу с наименьшим числом различных значений (столбцы с одним значением
+    группировку не дают и пропускаются), числовые столбцы суммируем.
+    Если числовых столбцов нет, считаем количество значений. Возвращает (group_by, agg_method, value_cols)
+    или None, если в таблице один столбец.
+    """
+    if len(df.columns) < 2:
+        return None
+
+    num_cols = df.select_dtypes(include='number').columns.tolist()
+    cardinality = {col: df[col].nunique() for col in df.columns if col not in num_cols}
+    cat_cols = [col for col, distinct in cardinality.items() if distinct > 1]
+    group_by = min(cat_cols, key=cardinality.get) if cat_cols else df.columns[0]
+
+    value_cols = [col for col in num_cols if col != group_by]
+    if value_cols:
+        return group_by, 'sum', value_cols
+    return group_by, 'count', [col for col in df.columns if col != group_by]
+
+
+def parse_pivot_plan(response):
+    """Разбирает ответ модели {"group_by": ..., "agg": ..., "values": [...]}.
+
+    Возвращает (group_by, agg_method, value_cols) или None, если ответ не в этом формате.
+    """
+    try:
+        plan = json.loads(response)
+        group_by = str(plan['group_by'])
+        agg_type = str(plan.get('agg', '')).lower()
+        value_cols = [str(col) for col in plan['values']]
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return None
+
+    # Определяем метод агрегации
+    agg_method = 'sum'
+    if agg_type == 'mean' or 'сред' in agg_type:
+        agg_method = 'mean'
+    elif 'колич' in agg_type or 'count' in agg_type:
+        agg_method = 'count'
+    return group_by, agg_method, value_cols
+
+
+def build_pivot_table(df, pivot_spec):
+    """Строит сводную таблицу по плану (group_by, agg_method, value_cols).
+
+    Возвращает None, если плана нет или в нём нет подходящих столбцов.
+    """
+    if pivot_spec is None or pivot_spec[0] not in df.columns:
+        return None
+
+    group_by, agg_method, value_cols = pivot_spec
+    # Создаем словарь для агрегаций. Сумму и среднее считаем только по числовым столбцам: на текстовом
+    # столбце groupby упал бы с ошибкой (или склеил строки), и сводная таблица пропала бы целиком
+    if agg_method == 'count':
+        allowed = set(df.columns)
+    else:
+        allowed = set(df.select_dtypes(include='number').columns)
+    agg_dict = {col: agg_method for col in value_cols if col in allowed and col != group_by}
+    if not agg_dict:
+        return None
+
+    print(f"Создаю сводную таблицу с группировкой по '{group_by}'...")
+    # groupby в pandas уже агрегирует скомпилированным кодом по кодам групп
+    return df.groupby(group_by).agg(agg_dict).reset_index()
+
+
+def load_file(file_path, engine='auto', use_cache=True, cache_dir=DEFAULT_CACHE_DIR, timeout=600):
+    """Загружает Excel-файл в базу и возвращает сессию с подключением и описанием таблицы.
+
+    Сессии хранятся в процессе по хешу файла (LRU на MAX_SESSIONS книг): при повторных запросах к той же
+    книге из одного процесса Excel не читается, а база не открывается заново. Между запусками скрипта
+    данные переживает дисковый кэш в cache_dir.
+    """
+    table_name = 'data'  # Стандартное имя таблицы
+
+    # Запросы здесь только читают одну загруженную таблицу: колоночный DuckDB выполняет такие
+    # сканирования и агрегации векторно и параллельно, намного быстрее построчного SQLite
+    engine = resolve_engine(engine)
+    sql_dialect = 'DuckDB' if engine == 'duckdb' else 'SQLite'
+    db_extension = 'duckdb' if engine == 'duckdb' else 'sqlite'
+
+    # Загруженная в этом процессе книга используется повторно, пока не изменится
+    file_hash = get_file_hash(file_path)
+    session_key = (file_hash, engine)
+    if session_key in SESSIONS:
+        SESSIONS.move_to_end(session_key)
+        print(f"Используем уже загруженные данные для файла {file_path}")
+        return SESSIONS[session_key]
+
+    # Кэш — готовая база, названная по хешу содержимого файла: повторный запуск по тому же файлу
+    # не читает Excel и не собирает базу заново, а изменённый файл получает новую базу
+    if use_cache:
+        os.makedirs(cache_dir, exist_ok=True)
+        db_file = os.path.join(cache_dir, f"table_{file_hash}.{db_extension}")
+        # База собирается во временном файле и публикуется переименованием, когда полностью готова,
+        # чтобы параллельный запуск не прочитал недостроенную базу
+        build_file = f"{db_file}.{os.getpid()}.tmp"
+    else:
+        # Создание временного имени для базы данных
+        db_file = f"temp_db_{os.path.basename(file_path).replace('.', '_')}.{db_extension}"
+        build_file = db_file
+    meta_file = f"{db_file}.json"
+
+    # === Шаг 1. Загрузка Excel-файла в базу ===
+    sheet_names = []
+    cache_hit = False
+
+    # Проверяем, есть ли файл в кэше и нужно ли его использовать
+    # (описание открываем сразу, без отдельной проверки существования: его нет — кэша нет)
+    if use_cache and os.path.exists(db_file):
+        try:
+            with open(meta_file, 'r', encoding='utf-8') as f:
+                cache_meta = json.load(f)
+            sheet_names = cache_meta['sheets']
+            cache_hit = True
+            touch_cache_file(db_file)
+            print(f"Используем кэшированные данные для файла {file_path}")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Не удалось прочитать кэш, файл будет обработан заново: {e}")
+
+    try:
+        conn = open_database(db_file if cache_hit else build_file, timeout, cache_hit, engine)
+    except Exception as e:
+        print(f"Ошибка при работе с базой данных: {e}")
+        sys.exit(1)
+
+    if not cache_hit:
+        adbc_conn = None
+        try:
+            # Получаем список всех листов в файле
+            excel_file = pd.ExcelFile(file_path, engine=EXCEL_ENGINE)
+            sheet_names = excel_file.sheet_names
+            print(f"Файл содержит {len(sheet_names)} листов: {', '.join(sheet_names)}")
+
+            # Каждый лист сразу дописывается в таблицу SQLite: листы не собираются в общий DataFrame,
+            # поэтому в памяти одновременно находится только один лист
+            if engine == 'sqlite' and adbc_sqlite is not None:
+                adbc_conn = adbc_sqlite.connect(build_file)
+
+            # Книга открывается и распаковывается один раз: каждый лист читается из уже открытого ExcelFile
+            try:
+                known_columns = set()
+                total_rows = 0
+                for sheet_name in sheet_names:
+                    print(f"Читаю лист '{sheet_name}'...")
+                    # Повторное чтение имеет смысл только при ошибке ввода-вывода или повреждённом архиве:
+                    # тогда один раз пробуем openpyxl. Остальные ошибки детерминированы и сразу уходят наверх
+                    try:
+                        df_sheet = pd.read_excel(excel_file, sheet_name=sheet_name)
+                    except (OSError, zipfile.BadZipFile) as e:
+                        print(f"Ошибка при чтении листа {sheet_name}: {e}. Пробую прочитать через openpyxl...")
+                        df_sheet = pd.read_excel(file_path, sheet_name=sheet_name, engine='openpyxl')
+                    print(
+                        f"Лист '{sheet_name}' прочитан. Количество строк: {len(df_sheet)}, столбцов: {len(df_sheet.columns)}")
+
+                    # === Шаг 2. Импорт листа в базу ===
+                    try:
+                        if engine == 'duckdb':
+                            # DuckDB не регистрирует DataFrame без столбцов: пустой лист пропускаем
+                            if df_sheet.columns.empty:
+                                continue
+                            append_sheet_duckdb(conn, df_sheet, table_name, sheet_name, not known_columns)
+                            known_columns.update(df_sheet.columns)
+                            known_columns.add('_sheet_name')
+                        else:
+                            # Столбец с именем листа для отслеживания
+                            column_types = [(str(name), sqlite_column_type(dtype))
+                                            for name, dtype in df_sheet.dtypes.items()]
+                            column_types.append(('_sheet_name', 'TEXT'))
+                            add_table_columns(conn, table_name, column_types, known_columns)
+
+                            # Колоночная загрузка через Arrow/ADBC; столбцы со смешанными типами значений
+                            # Arrow не принимает, тогда загружаем лист через pandas.to_sql
+                            imported = False
+                            if adbc_conn is not None:
+                                try:
+                                    append_sheet_adbc(adbc_conn, df_sheet, table_name, sheet_name)
+                                    imported = True
+                                except Exception as e:
+                                    print(f"Колоночная загрузка не удалась, используем pandas.to_sql: {e}")
+                            if not imported:
+                                df_sheet['_sheet_name'] = sheet_name
+                                df_sheet.to_sql(table_name, conn, if_exists='append', index=False, chunksize=5000)
+                    except Exception as e:
+                        print(f"Ошибка при работе с базой данных: {e}")
+                        sys.exit(1)
+                    total_rows += len(df_sheet)
+                    del df_sheet
+                if engine == 'duckdb' and not known_columns:
+                    # Все листы пустые: таблица из одного столбца с именем листа, как в SQLite
+                    conn.execute(f'CREATE TABLE "{table_name}" (_sheet_name VARCHAR)')
+            finally:
+                excel_file.close()
+                if adbc_conn is not None:
+                    adbc_conn.close()
+
+            print(f"Данные успешно импортированы в {sql_dialect}. Общее количество строк: {total_rows}, "
+                  f"столбцов: {len(known_columns)}")
+        except SystemExit:
+            discard_build_file(conn, build_file, db_file)
+            raise
+        except Exception as e:
+            discard_build_file(conn, build_file, db_file)
+            print(f"Ошибка при чтении файла Excel: {e}")
+            sys.exit(1)
+
+        # Публикуем готовую базу в кэше и запоминаем список листов, чтобы следующие запуски не читали Excel
+        if use_cache:
+            try:
+                conn.close()
+                os.replace(build_file, db_file)
+                with open(meta_file, 'w', encoding='utf-8') as f:
+                    json.dump({'sheets': sheet_names}, f, ensure_ascii=False)
+                conn = open_database(db_file, timeout, True, engine)
+                # Базы, открытые в сессиях этого процесса, не удаляем
+                evict_cache_files(cache_dir, 'table_', ('.sqlite', '.duckdb'), CACHE_MAX_TABLES,
+                                  companions=('.json', '.wal'),
+                                  exclude={db_file, *(session['db_file'] for session in SESSIONS.values())})
+            except Exception as e:
+                print(f"Ошибка при работе с базой данных: {e}")
+                sys.exit(1)
+
+    # === Шаг 3. Показываем пользователю образец данных и названия столбцов ===
+    try:
+        cursor = conn.cursor()
+        # Примеры значений собираем по столбцам, а не строками целиком: на широких таблицах строка-кортеж
+        # раздувает промпт, а несколько значений под именем столбца лучше показывают модели формат данных
+        cursor.execute(f"SELECT * FROM {table_name} LIMIT {SAMPLE_ROWS}")
+        sample_data = cursor.fetchall()
+        sample_columns = [description[0] for description in cursor.description]
+        sample_str_sql = "\n".join(
+            f"  {name}: [{', '.join('NULL' if row[i] is None else str(row[i]) for row in sample_data)}]"
+            for i, name in enumerate(sample_columns))
+
+        # DuckDB отдаёт типы столбцов прямо в описании результата выборки, отдельный запрос не нужен.
+        # sqlite3 в описании возвращает только имена, объявленные типы есть лишь в PRAGMA table_info
+        if engine == 'duckdb':
+            column_types = [(description[0], str(description[1])) for description in cursor.description]
+        else:
+            cursor.execute(f"PRAGMA table_info({table_name});")
+            column_types = [(col[1], col[2]) for col in cursor.fetchall()]
+
+        # Описание схемы и список имён столбцов для промптов
+        schema_str = "\n".join(f" - {name} ({col_type})" for name, col_type in column_types)
+        column_names_str = ", ".join(f'"{name}"' if ' ' in str(name) else str(name) for name, _ in column_types)
+
+        print("\nСхема таблицы:")
+        print(schema_str)
+    except Exception as e:
+        print(f"Ошибка при извлечении данных из SQL: {e}")
+        conn.close()
+        sys.exit(1)
+
+    session = {
+        'conn': conn,
+        'engine': engine,
+        'sql_dialect': sql_dialect,
+        'db_file': db_file,
+        'file_hash': file_hash,
+        'table_name': table_name,
+        'sheet_names': sheet_names,
+        'schema_str': schema_str,
+        'sample_str_sql': sample_str_sql,
+        'column_names_str': column_names_str,
+    }
+    SESSIONS[session_key] = session
+    # Самую давно не использованную книгу закрываем, чтобы не держать открытыми все базы
+    if len(SESSIONS) > MAX_SESSIONS:
+        _, old_session = SESSIONS.popitem(last=False)
+        old_session['conn'].close()
+    return session
+
+
+def close_session(session):
+    """Закрывает базу книги после запроса, если книги не хранятся между запросами (KEEP_SESSIONS)."""
+    if KEEP_SESSIONS:
+        return
+    SESSIONS.pop((session['file_hash'], session['engine']), None)
+    session['conn'].close()
+
+
+def print_user_result(text, output_file=None):
+    """Выводит блок ответа для пользователя (баннер, текст и путь к файлу) одной записью в stdout.
+
+    Бот читает stdout через pipe: весь блок уходит одним системным вызовом, а не построчными print.
+    """
+    out = io.StringIO()
+    out.write("\n=== РЕЗУЛЬТАТ ДЛЯ ПОЛЬЗОВАТЕЛЯ ===\n\n")
+    out.write(f"{text}\n")
+    if output_file:
+        out.write(f"\nТаблица сохранена в файл: {output_file}\n")
+    sys.stdout.write(out.getvalue())
+    sys.stdout.flush()
+
+
+def start_background_import(module_name):
+    """Начинает импорт модуля в фоновом потоке и возвращает поток: перед использованием модуля его нужно дождаться.
+
+    Если импорт в потоке не удался, повторный import в основном потоке покажет настоящую ошибку.
+    """
+    thread = threading.Thread(target=importlib.import_module, args=(module_name,), daemon=True)
+    thread.start()
+    return thread
 
 
 def main():
+    # Пакет openai импортируется около трети секунды, а нужен только после загрузки файла в базу:
+    # импортируем его в фоне, пока разбираются аргументы и читается Excel или кэш
+    openai_import = start_background_import('openai')
+
     # Парсинг аргументов командной строки
     parser = argparse.ArgumentParser(description='Создание таблиц и сводных отчетов из Excel-файла')
     parser.add_argument('file_path', help='Путь к Excel-файлу')
@@ -86,8 +965,16 @@ def main():
     parser.add_argument('--execute-sql', action='store_true', help='Выполнить указанный SQL-запрос')
     parser.add_argument('--columns', help='Список столбцов, разделенных запятыми')
     parser.add_argument('--sql', help='SQL-запрос для выполнения')
-    parser.add_argument('--cache', action='store_true', help='Использовать кэширование данных')
+    parser.add_argument('--cache', action='store_true',
+                        help='Использовать кэширование данных (включено по умолчанию, оставлено для совместимости)')
+    parser.add_argument('--no-cache', action='store_true', help='Не использовать кэш: каждый раз читать Excel заново')
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR,
+                        help=f'Каталог для кэша данных (по умолчанию: {DEFAULT_CACHE_DIR})')
     parser.add_argument('--timeout', type=int, default=600, help='Таймаут выполнения SQL-запроса в секундах')
+    parser.add_argument('--llm-pivot', action='store_true',
+                        help='Спрашивать у модели группировку для сводной таблицы (по умолчанию выбирается по типам столбцов)')
+    parser.add_argument('--engine', choices=['auto', 'duckdb', 'sqlite'], default='auto',
+                        help='Движок SQL: auto — DuckDB, если пакет установлен, иначе SQLite')
 
     args = parser.parse_args()
 
@@ -103,144 +990,26 @@ def main():
     # Настройка API ключа
     api_key = os.getenv("CHATGPT_API_KEY")
 
-    # Создание клиента OpenAI
-    client = OpenAI(api_key=api_key)
-
-    # Создание временного имени для базы данных
-    db_file = f"temp_db_{os.path.basename(args.file_path).replace('.', '_')}.sqlite"
-    table_name = 'data'  # Стандартное имя таблицы
-
-    # Проверка наличия данных в кэше
-    file_hash = get_file_hash(args.file_path)
-    cache_key = f"{file_hash}_{db_file}"
+    # Каталог для кэша ответов модели и результатов запросов (None — кэш выключен)
+    cache_dir = None if args.no_cache else args.cache_dir
 
     try:
-        # === Шаг 1. Загрузка Excel-файла в DataFrame ===
-        df = None
-        sheet_names = []
-
-        # Проверяем, есть ли файл в кэше и нужно ли его использовать
-        if args.cache and cache_key in file_cache and os.path.exists(db_file):
-            print(f"Используем кэшированные данные для файла {args.file_path}")
-            df = file_cache[cache_key]['dataframe']
-            sheet_names = file_cache[cache_key]['sheets']
-        else:
-            try:
-                # Получаем список всех листов в файле
-                excel_file = pd.ExcelFile(args.file_path)
-                sheet_names = excel_file.sheet_names
-                print(f"Файл содержит {len(sheet_names)} листов: {', '.join(sheet_names)}")
-
-                # Если листов несколько, обрабатываем каждый лист
-                all_dfs = []
-                for sheet_name in sheet_names:
-                    print(f"Читаю лист '{sheet_name}'...")
-                    # Добавляем обработку ошибок и повторные попытки для больших файлов
-                    for attempt in range(3):  # Пробуем до 3 раз
-                        try:
-                            # Пытаемся разными способами прочитать файл
-                            try:
-                                df_sheet = pd.read_excel(args.file_path, sheet_name=sheet_name)
-                            except:
-                                # Пробуем с другими параметрами
-                                df_sheet = pd.read_excel(args.file_path, sheet_name=sheet_name, engine='openpyxl')
-
-                            # Добавляем столбец с именем листа для отслеживания
-                            df_sheet['_sheet_name'] = sheet_name
-                            all_dfs.append(df_sheet)
-                            print(
-                                f"Лист '{sheet_name}' прочитан. Количество строк: {len(df_sheet)}, столбцов: {len(df_sheet.columns) - 1}")
-                            break  # Успешно прочитали, выходим из цикла попыток
-                        except Exception as e:
-                            print(f"Ошибка при чтении листа {sheet_name}, попытка {attempt + 1}: {e}")
-                            if attempt == 2:  # Последняя попытка не удалась
-                                raise
-                            time.sleep(1)  # Пауза перед повторной попыткой
-
-                # Объединяем все датафреймы в один, если их несколько
-                if len(all_dfs) > 1:
-                    df = pd.concat(all_dfs, ignore_index=True)
-                    print(f"Все листы объединены. Общее количество строк: {len(df)}, столбцов: {len(df.columns)}")
-                else:
-                    df = all_dfs[0]
-                    print(f"Файл успешно прочитан. Количество строк: {len(df)}, столбцов: {len(df.columns)}")
-
-                # Сохраняем в кэш, если включено кэширование
-                if args.cache:
-                    file_cache[cache_key] = {
-                        'dataframe': df,
-                        'sheets': sheet_names
-                    }
-            except Exception as e:
-                print(f"Ошибка при чтении файла Excel: {e}")
-                sys.exit(1)
-
-        # === Шаг 2. Импорт данных в SQLite ===
-
-        try:
-            # Проверяем, нужно ли создавать базу данных заново
-            if not args.cache or not os.path.exists(db_file):
-                conn = sqlite3.connect(db_file, timeout=args.timeout)
-                # Увеличиваем таймаут для больших запросов - исправленная версия
-                conn.execute(f"PRAGMA busy_timeout = {args.timeout * 1000}")  # Исправлено: убраны скобки ?
-                # Оптимизируем память и скорость
-                conn.execute("PRAGMA synchronous = OFF")
-                conn.execute("PRAGMA journal_mode = MEMORY")
-                conn.execute("PRAGMA temp_store = MEMORY")
-                conn.execute("PRAGMA cache_size = 10000")
-
-                # Сохраняем данные пакетами для больших файлов
-                chunk_size = 5000
-                if len(df) > chunk_size:
-                    for i in range(0, len(df), chunk_size):
-                        chunk = df.iloc[i:i + chunk_size]
-                        if i == 0:
-                            chunk.to_sql(table_name, conn, if_exists='replace', index=False)
-                        else:
-                            chunk.to_sql(table_name, conn, if_exists='append', index=False)
-                        print(f"Импортировано строк: {min(i + chunk_size, len(df))} из {len(df)}")
-                else:
-                    df.to_sql(table_name, conn, if_exists='replace', index=False)
-                print(f"Данные успешно импортированы в SQLite.")
-            else:
-                conn = sqlite3.connect(db_file, timeout=args.timeout)
-                # Увеличиваем таймаут для больших запросов - исправленная версия
-                conn.execute(f"PRAGMA busy_timeout = {args.timeout * 1000}")  # Исправлено: убраны скобки ?
-        except Exception as e:
-            print(f"Ошибка при работе с базой данных: {e}")
-            sys.exit(1)
-
-
-
-        # === Шаг 3. Показываем пользователю образец данных и названия столбцов ===
-        try:
-            cursor = conn.cursor()
-            cursor.execute(f"SELECT * FROM {table_name} LIMIT 10")
-            sample_data = cursor.fetchall()
-            sample_str_sql = "\n".join([str(row) for row in sample_data])
-
-            # Получаем информацию о столбцах через PRAGMA
-            cursor.execute(f"PRAGMA table_info({table_name});")
-            columns_info = cursor.fetchall()
-
-            # Формирование строкового описания схемы
-            schema_lines = []
-            for col in columns_info:
-                col_name = col[1]
-                col_type = col[2]
-                schema_lines.append(f" - {col_name} ({col_type})")
-            schema_str = "\n".join(schema_lines)
-
-            # Получаем имена столбцов для дальнейшего использования
-            column_names_list = [col[1] for col in columns_info]
-            column_names_str = ", ".join([f'"{col}"' if ' ' in str(col) else str(col) for col in column_names_list])
-
-            print("\nСхема таблицы:")
-            print(schema_str)
-        except Exception as e:
-            print(f"Ошибка при извлечении данных из SQL: {e}")
-            conn.close()
-            sys.exit(1)
+        # === Шаги 1-3. Загрузка файла в базу и описание таблицы ===
+        session = load_file(args.file_path, args.engine, not args.no_cache, args.cache_dir, args.timeout)
+        conn = session['conn']
+        engine = session['engine']
+        sql_dialect = session['sql_dialect']
+        db_file = session['db_file']
+        table_name = session['table_name']
+        sheet_names = session['sheet_names']
+        schema_str = session['schema_str']
+        sample_str_sql = session['sample_str_sql']
+        column_names_str = session['column_names_str']
+
+        # Создание клиента OpenAI (пакет к этому моменту уже импортирован в фоне)
+        openai_import.join()
+        from openai import OpenAI
+        client = OpenAI(api_key=api_key)
 
         # Проверяем режим работы скрипта на основе аргументов командной строки
         if args.analyze_only:
@@ -252,7 +1021,7 @@ def main():
 Названия столбцов: {column_names_str}
 Схема таблицы:
 {schema_str}
-Первые 10 строк из SQL-таблицы:
+Примеры значений столбцов (первые строки таблицы):
 {sample_str_sql}
 
 Выбери и перечисли только те столбцы, которые потребуются для создания запрошенной таблицы/отчета. 
@@ -261,7 +1030,7 @@ def main():
 
             suggested_columns = chat_with_gpt(client, args.model, columns_prompt, temperature=0.3)
             print(f"COLUMNS_INFO_START\n{suggested_columns}\nCOLUMNS_INFO_END")
-            conn.close()
+            close_session(session)
             sys.exit(0)
 
         elif args.sql_only:
@@ -270,14 +1039,14 @@ def main():
 
             sql_prompt = f"""
 Используя следующие столбцы: {selected_columns}
-Таблица называется '{table_name}' (SQLite).
+Таблица называется '{table_name}' ({sql_dialect}).
 Запрос пользователя: "{args.query}"
 Схема таблицы:
 {schema_str}
-Первые 10 строк из SQL-таблицы:
+Примеры значений столбцов (первые строки таблицы):
 {sample_str_sql}
 
-Сформируй, пожалуйста, корректный SQL-запрос (SQLite) для получения итогового ответа.
+Сформируй, пожалуйста, корректный SQL-запрос ({sql_dialect}) для получения итогового ответа.
 Важно:
 - Возвращай только SQL-запрос, начиная с ключевого слова SELECT, без лишнего текста или комментариев.
 - Если имя столбца содержит пробелы или спецсимволы, оборачивай его в двойные кавычки.
@@ -296,15 +1065,10 @@ def main():
             sql_response = chat_with_gpt(client, args.model, sql_prompt, temperature=0)
 
             # Извлечем SQL-запрос, если он обернут в тройные кавычки
-            if "```sql" in sql_response and "```" in sql_response.split("```sql", 1)[1]:
-                sql_query = sql_response.split("```sql", 1)[1].split("```", 1)[0].strip()
-            elif "```" in sql_response and "```" in sql_response.split("```", 1)[1]:
-                sql_query = sql_response.split("```", 1)[1].split("```", 1)[0].strip()
-            else:
-                sql_query = sql_response.strip()
+            sql_query = extract_sql(sql_response)
 
             print(f"SQL_QUERY_START\n{sql_query}\nSQL_QUERY_END")
-            conn.close()
+            close_session(session)
             sys.exit(0)
 
         elif args.execute_sql:
@@ -312,153 +1076,88 @@ def main():
             sql_query = args.sql
 
             try:
-                # Настраиваем коннектор и объем памяти для больших запросов
-                conn.row_factory = sqlite3.Row  # Позволяет обращаться к столбцам по имени
-
                 # Устанавливаем максимальный размер таблицы в памяти и другие оптимизации
-                conn.execute("PRAGMA temp_store = MEMORY")
-                conn.execute("PRAGMA mmap_size = 30000000000")  # ~30GB
-
-                # Выполняем запрос с обработкой возможного таймаута
-                cursor = conn.cursor()
-                start_time = time.time()
+                if engine == 'sqlite':
+                    conn.execute("PRAGMA temp_store = MEMORY")
+                    conn.execute("PRAGMA mmap_size = 30000000000")  # ~30GB
 
                 print(f"Начало выполнения SQL-запроса... (таймаут: {args.timeout} сек)")
-                cursor.execute(sql_query)
-
-                # Извлекаем результаты в виде списка словарей для удобства конвертации в DataFrame
-                columns = [desc[0] for desc in cursor.description]
-
-                # Извлекаем данные небольшими частями, чтобы не перегрузить память
-                BATCH_SIZE = 1000
-                all_results = []
-                rows_processed = 0
-
-                while True:
-                    batch = cursor.fetchmany(BATCH_SIZE)
-                    if not batch:
-                        break
-                    all_results.extend([dict(zip(columns, row)) for row in batch])
-                    rows_processed += len(batch)
-
-                    elapsed = time.time() - start_time
-                    if rows_processed % 10000 == 0:
-                        print(f"Обработано строк: {rows_processed} за {elapsed:.2f} сек")
-
-                    # Проверяем таймаут
-                    if elapsed > args.timeout:
-                        print(f"Превышено время выполнения запроса ({args.timeout} сек).")
-                        break
-
-                query_result = all_results
-                columns_desc = columns
+                start_time = time.time()
+                df_result = cached_query_result(conn, db_file, sql_query, args.timeout, engine,
+                                                result_cache_path(cache_dir, session['file_hash'], engine, sql_query))
 
                 end_time = time.time()
-                print(f"Запрос выполнен за {end_time - start_time:.2f} сек. Получено строк: {len(query_result)}")
+                print(f"Запрос выполнен за {end_time - start_time:.2f} сек. Получено строк: {len(df_result)}")
 
-                if not query_result:
+                if df_result.empty:
                     print("\nНичего не найдено по вашему запросу.")
-                    clar_prompt = f"""Запрос:
-{sql_query}
+                    clar_prompt = EMPTY_RESULT_PROMPT.format(sql_query=sql_query)
 
-Результат пустой. Возможно, не нашлось данных, удовлетворяющих условиям.
-Сформулируй уточняющий вопрос или возможную причину, почему нет данных. Также предложи, как можно изменить запрос, чтобы получить результаты."""
-
-                    clar_response = chat_with_gpt(client, args.model, clar_prompt, temperature=0.7)
+                    clar_response = cached_chat(client, args.model, clar_prompt, temperature=0.7,
+                                                cache_dir=cache_dir)
 
-                    print("\n=== РЕЗУЛЬТАТ ДЛЯ ПОЛЬЗОВАТЕЛЯ ===\n")
-                    print(clar_response.strip())
+                    print_user_result(clar_response.strip())
                 else:
+                    # Размер и список столбцов результата нужны обоим промптам (описание и план сводной таблицы)
+                    n_rows, n_cols = df_result.shape
+                    col_list = summarize_columns(df_result.columns)
+
+                    # Описание таблицы не зависит от файла и сводной таблицы: запрашиваем его сразу,
+                    # ответ придёт, пока сохраняется файл
+                    description_prompt = DESCRIPTION_PROMPT.format(query=args.query, n_rows=n_rows, n_cols=n_cols,
+                                                                   col_list=col_list, head_rows=head_rows_json(df_result))
+                    description_future = start_chat_with_gpt(client, args.model, description_prompt, temperature=0.7,
+                                                             cache_dir=cache_dir)
+
+                    # План сводной таблицы по --llm-pivot запрашиваем у модели вместе с описанием: он зависит только
+                    # от запроса и столбцов, поэтому оба ответа готовятся параллельно
+                    pivot_future = None
+                    if args.llm_pivot and len(df_result) > 1000:
+                        summary_prompt = PIVOT_PLAN_PROMPT.format(query=args.query, n_rows=n_rows, col_list=col_list)
+                        pivot_future = start_chat_with_gpt(client, STRUCTURAL_MODEL, summary_prompt, temperature=0,
+                                                           cache_dir=cache_dir, response_format={"type": "json_object"})
+
                     # Сохраняем результат в Excel
-                    df_result = pd.DataFrame(query_result)
                     output_file = args.output
 
                     # Оптимизируем сохранение для больших результатов
                     print(f"Сохраняю результаты в {output_file}...")
 
-                    # Создаем Excel-writer с оптимизированными настройками
-                    with pd.ExcelWriter(output_file, engine='openpyxl') as writer:
-                        df_result.to_excel(writer, index=False, sheet_name='Результаты')
-
-                        # Если результат большой, сохраняем также сводную таблицу
-                        if len(df_result) > 1000:
-                            try:
-                                # Пробуем создать сводную таблицу для большого набора данных
-                                # На основе запроса пользователя определяем ключевые поля
-                                summary_prompt = f"""
-На основе запроса пользователя: "{args.query}"
-И структуры результирующей таблицы с {len(df_result)} строками и столбцами: {', '.join(df_result.columns)}
-
-Определи:
-1. Какой столбец лучше всего использовать для группировки данных в сводной таблице?
-2. Какое агрегирование следует применить (сумма, среднее, количество)?
-3. Какие столбцы стоит вывести в качестве значений?
-
-Верни только название столбца для группировки, тип агрегирования и названия столбцов для значений, разделенные запятыми.
-"""
-                                summary_response = chat_with_gpt(client, args.model, summary_prompt,
-                                                                 temperature=0.5).strip()
-
-                                # Разбираем ответ
-                                parts = summary_response.split(',')
-                                if len(parts) >= 3:
-                                    group_by = parts[0].strip()
-                                    agg_type = parts[1].strip()
-                                    value_cols = [col.strip() for col in parts[2:]]
-
-                                    if group_by in df_result.columns:
-                                        # Создаем сводную таблицу
-                                        print(f"Создаю сводную таблицу с группировкой по '{group_by}'...")
-
-                                        # Определяем метод агрегации
-                                        agg_method = 'sum'
-                                        if 'сред' in agg_type.lower():
-                                            agg_method = 'mean'
-                                        elif 'колич' in agg_type.lower() or 'count' in agg_type.lower():
-                                            agg_method = 'count'
-
-                                        # Создаем словарь для агрегаций
-                                        agg_dict = {col: agg_method for col in value_cols if col in df_result.columns}
-
-                                        if agg_dict:
-                                            # Создаем сводную таблицу
-                                            pivot_df = df_result.groupby(group_by).agg(agg_dict).reset_index()
-                                            pivot_df.to_excel(writer, index=False, sheet_name='Сводная')
-                            except Exception as e:
-                                print(f"Не удалось создать сводную таблицу: {e}")
-
-                    summary_prompt = f"""
-Я создал таблицу по запросу пользователя: "{args.query}"
-
-Получилась таблица размером {len(df_result)} строк на {len(df_result.columns)} столбцов.
-Столбцы таблицы: {', '.join(df_result.columns.tolist())}
-
-Первые 5 строк таблицы:
-{df_result.head().to_string(index=False)}
+                    # Если результат большой, готовим также сводную таблицу. Она строится до открытия файла:
+                    # ответ модели (с --llm-pivot) ждём, пока итоговый файл ещё не открыт на запись
+                    pivot_df = None
+                    if len(df_result) > 1000:
+                        try:
+                            # Группировку и агрегирование выводим по типам столбцов; модель спрашиваем только с --llm-pivot
+                            if pivot_future is not None:
+                                pivot_spec = parse_pivot_plan(pivot_future.result())
+                            else:
+                                pivot_spec = infer_pivot_spec(df_result)
+                            pivot_df = build_pivot_table(df_result, pivot_spec)
+                        except Exception as e:
+                            print(f"Не удалось создать сводную таблицу: {e}")
 
-Опиши кратко (2-3 предложения), что представляет собой эта таблица и какую информацию она содержит.
-"""
+                    # Создаем Excel-writer с оптимизированными настройками
+                    with open_excel_writer(output_file) as writer:
+                        write_excel_sheet(writer, df_result, 'Результаты')
+                        if pivot_df is not None:
+                            write_excel_sheet(writer, pivot_df, 'Сводная')
 
-                    table_description = chat_with_gpt(client, args.model, summary_prompt, temperature=0.7)
+                    table_description = description_future.result()
 
-                    print("\n=== РЕЗУЛЬТАТ ДЛЯ ПОЛЬЗОВАТЕЛЯ ===\n")
-                    print(table_description.strip())
-            except sqlite3.OperationalError as e:
+                    print_user_result(table_description.strip())
+            except SQL_ERRORS as e:
                 if "timeout" in str(e):
                     print(f"\nОшибка: Превышено время выполнения SQL-запроса. {e}")
-                    print("\n=== РЕЗУЛЬТАТ ДЛЯ ПОЛЬЗОВАТЕЛЯ ===\n")
-                    print(
-                        "Запрос слишком сложный и требует больше времени для выполнения. Пожалуйста, упростите запрос или дайте более конкретные условия фильтрации.")
+                    print_user_result("Запрос слишком сложный и требует больше времени для выполнения. Пожалуйста, упростите запрос или дайте более конкретные условия фильтрации.")
                 else:
                     print(f"\nОшибка при выполнении SQL-запроса: {e}")
-                    print("\n=== РЕЗУЛЬТАТ ДЛЯ ПОЛЬЗОВАТЕЛЯ ===\n")
-                    print(f"Произошла ошибка при выполнении запроса: {e}")
+                    print_user_result(f"Произошла ошибка при выполнении запроса: {e}")
             except Exception as e:
                 print(f"\nОшибка при выполнении SQL-запроса: {e}")
-                print("\n=== РЕЗУЛЬТАТ ДЛЯ ПОЛЬЗОВАТЕЛЯ ===\n")
-                print(f"Произошла ошибка при выполнении запроса: {e}")
+                print_user_result(f"Произошла ошибка при выполнении запроса: {e}")
 
-            conn.close()
+            close_session(session)
             sys.exit(0)
 
         # === Если не указан специальный режим, выполняем стандартный алгоритм ===
@@ -471,7 +1170,7 @@ def main():
 Названия столбцов: {column_names_str}
 Схема таблицы:
 {schema_str}
-Первые 10 строк из SQL-таблицы:
+Примеры значений столбцов (первые строки таблицы):
 {sample_str_sql}
 
 Выбери и перечисли только те столбцы, которые потребуются для создания запрошенной таблицы/отчета. 
@@ -484,22 +1183,22 @@ def main():
             print(suggested_columns)
         except Exception as e:
             print(f"Ошибка при вызове GPT для определения столбцов: {e}")
-            conn.close()
+            close_session(session)
             sys.exit(1)
 
         # === Шаг 5B. Формируем промпт для генерации SQL-запроса с учётом формата данных ===
-        # Здесь передаём только выбранные столбцы и первые 10 строк из SQL (чтобы GPT увидела реальный формат данных)
+        # Здесь передаём только выбранные столбцы и примеры значений столбцов из SQL (чтобы GPT увидела реальный формат данных)
         selected_columns = suggested_columns
         sql_prompt = f"""
 Используя следующие столбцы: {selected_columns}
-Таблица называется '{table_name}' (SQLite).
+Таблица называется '{table_name}' ({sql_dialect}).
 Запрос пользователя: "{args.query}"
 Схема таблицы:
 {schema_str}
-Первые 10 строк из SQL-таблицы:
+Примеры значений столбцов (первые строки таблицы):
 {sample_str_sql}
 
-Сформируй, пожалуйста, корректный SQL-запрос (SQLite) для получения итогового ответа.
+Сформируй, пожалуйста, корректный SQL-запрос ({sql_dialect}) для получения итогового ответа.
 Важно:
 - Возвращай только SQL-запрос, начиная с ключевого слова SELECT, без лишнего текста или комментариев.
 - Если имя столбца содержит пробелы или спецсимволы, оборачивай его в двойные кавычки.
@@ -520,74 +1219,42 @@ def main():
             sql_response = chat_with_gpt(client, args.model, sql_prompt, temperature=0)
 
             # Извлечем SQL-запрос, если он обернут в тройные кавычки
-            if "```sql" in sql_response and "```" in sql_response.split("```sql", 1)[1]:
-                sql_query = sql_response.split("```sql", 1)[1].split("```", 1)[0].strip()
-            elif "```" in sql_response and "```" in sql_response.split("```", 1)[1]:
-                sql_query = sql_response.split("```", 1)[1].split("```", 1)[0].strip()
-            else:
-                sql_query = sql_response.strip()
+            sql_query = extract_sql(sql_response)
 
             # Проверяем, что ответ начинается с SELECT
-            if not sql_query.upper().startswith("SELECT"):
+            # Сравниваем только первые шесть символов, не копируя в верхний регистр весь ответ модели
+            if sql_query[:6].upper() != "SELECT":
                 print("Сгенерированный ответ не является корректным SQL-запросом. Проверьте промпт для GPT.")
-                conn.close()
+                close_session(session)
                 sys.exit(1)
 
             print("\nСгенерированный SQL-запрос:")
             print(sql_query)
         except Exception as e:
             print(f"Ошибка при вызове GPT для генерации SQL: {e}")
-            conn.close()
+            close_session(session)
             sys.exit(1)
 
 
         # === Шаг 6. Пытаемся выполнить SQL-запрос с обработкой возможных таймаутов ===
         try:
             # Устанавливаем таймаут и другие настройки SQLite для оптимизации
-            conn.execute(f"PRAGMA busy_timeout = {args.timeout * 1000}")
-            conn.execute("PRAGMA temp_store = MEMORY")
-            conn.execute("PRAGMA mmap_size = 30000000000")  # ~30GB
-
-            # Устанавливаем режим доступа по строкам для экономии памяти
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
+            if engine == 'sqlite':
+                conn.execute(f"PRAGMA busy_timeout = {args.timeout * 1000}")
+                conn.execute("PRAGMA temp_store = MEMORY")
+                conn.execute("PRAGMA mmap_size = 30000000000")  # ~30GB
 
             print(f"Начало выполнения SQL-запроса... (таймаут: {args.timeout} сек)")
             start_time = time.time()
 
-            # Выполняем запрос
-            cursor.execute(sql_query)
-
-            # Получаем имена столбцов из результата запроса
-            columns_desc = [description[0] for description in cursor.description]
-
-            # Извлекаем данные небольшими пакетами
-            BATCH_SIZE = 1000
-            all_results = []
-            rows_processed = 0
-
-            while True:
-                batch = cursor.fetchmany(BATCH_SIZE)
-                if not batch:
-                    break
-                all_results.extend([dict(zip(columns_desc, row)) for row in batch])
-                rows_processed += len(batch)
-
-                elapsed = time.time() - start_time
-                if rows_processed % 10000 == 0:
-                    print(f"Обработано строк: {rows_processed} за {elapsed:.2f} сек")
-
-                # Проверяем таймаут
-                if elapsed > args.timeout:
-                    print(f"Превышено время выполнения запроса ({args.timeout} сек).")
-                    break
-
-            query_result = all_results
+            # Выполняем запрос (или берём его результат из кэша)
+            df_result = cached_query_result(conn, db_file, sql_query, args.timeout, engine,
+                                            result_cache_path(cache_dir, session['file_hash'], engine, sql_query))
 
             end_time = time.time()
-            print(f"Запрос выполнен за {end_time - start_time:.2f} сек. Получено строк: {len(query_result)}")
+            print(f"Запрос выполнен за {end_time - start_time:.2f} сек. Получено строк: {len(df_result)}")
 
-        except sqlite3.OperationalError as e:
+        except SQL_ERRORS as e:
             if "timeout" in str(e):
                 print(f"\nОшибка: Превышено время выполнения SQL-запроса. {e}")
                 clar_prompt = f"""
@@ -598,13 +1265,13 @@ def main():
     Предложи, как можно упростить запрос или ограничить объем данных, не теряя сути запроса пользователя: "{args.query}".
     """
                 try:
-                    clar_response = chat_with_gpt(client, args.model, clar_prompt, temperature=0.7)
+                    clar_response = cached_chat(client, args.model, clar_prompt, temperature=0.7,
+                                                cache_dir=cache_dir)
                     clar_question = clar_response.strip()
                 except Exception:
                     clar_question = "Запрос слишком сложный и требует больше времени для выполнения. Пожалуйста, упростите запрос или дайте более конкретные условия фильтрации."
-                print("\n=== РЕЗУЛЬТАТ ДЛЯ ПОЛЬЗОВАТЕЛЯ ===\n")
-                print(clar_question)
-                conn.close()
+                print_user_result(clar_question)
+                close_session(session)
                 sys.exit(1)
             else:
                 print(f"\nОшибка при выполнении SQL-запроса: {e}")
@@ -614,128 +1281,93 @@ def main():
     При выполнении этого запроса возникла ошибка: {e}.
     Сформулируй, пожалуйста, уточняющий вопрос для пользователя, чтобы он мог скорректировать запрос или данные."""
                 try:
-                    clar_response = chat_with_gpt(client, args.model, clar_prompt, temperature=0.7)
+                    clar_response = cached_chat(client, args.model, clar_prompt, temperature=0.7,
+                                                cache_dir=cache_dir)
                     clar_question = clar_response.strip()
                 except Exception:
                     clar_question = f"Ошибка при выполнении запроса: {e}. Пожалуйста, проверьте запрос и формат данных."
-                print("\n=== РЕЗУЛЬТАТ ДЛЯ ПОЛЬЗОВАТЕЛЯ ===\n")
-                print(clar_question)
-                conn.close()
+                print_user_result(clar_question)
+                close_session(session)
                 sys.exit(1)
         except Exception as e:
             print(f"\nНепредвиденная ошибка при выполнении SQL-запроса: {e}")
-            print("\n=== РЕЗУЛЬТАТ ДЛЯ ПОЛЬЗОВАТЕЛЯ ===\n")
-            print(f"Произошла ошибка при выполнении запроса: {e}")
-            conn.close()
+            print_user_result(f"Произошла ошибка при выполнении запроса: {e}")
+            close_session(session)
             sys.exit(1)
 
         # === Шаг 7. Проверяем результат ===
-        if not query_result:
+        if df_result.empty:
             print("\nНичего не найдено по вашему запросу.")
-            clar_prompt = f"""Запрос:
-    {sql_query}
-
-    Результат пустой. Возможно, не нашлось данных, удовлетворяющих условиям.
-    Сформулируй уточняющий вопрос или возможную причину, почему нет данных. Также предложи, как можно изменить запрос, чтобы получить результаты."""
+            clar_prompt = EMPTY_RESULT_PROMPT.format(sql_query=sql_query)
             try:
-                clar_response = chat_with_gpt(client, args.model, clar_prompt, temperature=0.7)
+                clar_response = cached_chat(client, args.model, clar_prompt, temperature=0.7,
+                                            cache_dir=cache_dir)
                 clar_question = clar_response.strip()
             except Exception:
                 clar_question = "Ничего не найдено по вашему запросу. Возможно, стоит изменить условия фильтрации."
-            print("\n=== РЕЗУЛЬТАТ ДЛЯ ПОЛЬЗОВАТЕЛЯ ===\n")
-            print(clar_question)
-            conn.close()
+            print_user_result(clar_question)
+            close_session(session)
             sys.exit(1)
         else:
             # === Шаг 8. Если результат получен, сохраняем его в Excel-файл ===
             try:
-                print(f"Создаю итоговую таблицу... (строк: {len(query_result)})")
+                print(f"Создаю итоговую таблицу... (строк: {len(df_result)})")
+
+                # Размер и список столбцов результата нужны обоим промптам (описание и план сводной таблицы)
+                n_rows, n_cols = df_result.shape
+                col_list = summarize_columns(df_result.columns)
+
+                # Создаем краткое описание результата: оно не зависит от файла и сводной таблицы,
+                # поэтому запрашиваем его сразу, ответ придёт, пока сохраняется файл
+                description_prompt = DESCRIPTION_PROMPT.format(query=args.query, n_rows=n_rows, n_cols=n_cols,
+                                                               col_list=col_list, head_rows=head_rows_json(df_result))
+                description_future = start_chat_with_gpt(client, args.model, description_prompt, temperature=0.7,
+                                                         cache_dir=cache_dir)
+
+                # План сводной таблицы по --llm-pivot запрашиваем у модели вместе с описанием: он зависит только
+                # от запроса и столбцов, поэтому оба ответа готовятся параллельно
+                pivot_future = None
+                if args.llm_pivot and len(df_result) > 1000:
+                    summary_prompt = PIVOT_PLAN_PROMPT.format(query=args.query, n_rows=n_rows, col_list=col_list)
+                    pivot_future = start_chat_with_gpt(client, STRUCTURAL_MODEL, summary_prompt, temperature=0,
+                                                       cache_dir=cache_dir, response_format={"type": "json_object"})
 
-                # Преобразуем список словарей в DataFrame
-                df_result = pd.DataFrame(query_result)
                 output_file = args.output
 
-                # Оптимизируем сохранение для больших результатов
-                with pd.ExcelWriter(output_file, engine='openpyxl') as writer:
-                    df_result.to_excel(writer, index=False, sheet_name='Результаты')
+                # Если результат большой, готовим также сводную таблицу. Она строится до открытия файла:
+                # ответ модели (с --llm-pivot) ждём, пока итоговый файл ещё не открыт на запись
+                pivot_df = None
+                if len(df_result) > 1000:
+                    try:
+                        # Группировку и агрегирование выводим по типам столбцов; модель спрашиваем только с --llm-pivot
+                        if pivot_future is not None:
+                            pivot_spec = parse_pivot_plan(pivot_future.result())
+                        else:
+                            pivot_spec = infer_pivot_spec(df_result)
+                        pivot_df = build_pivot_table(df_result, pivot_spec)
+                    except Exception as e:
+                        print(f"Не удалось создать сводную таблицу: {e}")
 
-                    # Если результат большой, сохраняем также сводную таблицу
-                    if len(df_result) > 1000:
-                        try:
-                            # Пробуем создать сводную таблицу для большого набора данных
-                            # На основе запроса пользователя определяем ключевые поля
-                            summary_prompt = f"""
-    На основе запроса пользователя: "{args.query}"
-    И структуры результирующей таблицы с {len(df_result)} строками и столбцами: {', '.join(df_result.columns)}
-
-    Определи:
-    1. Какой столбец лучше всего использовать для группировки данных в сводной таблице?
-    2. Какое агрегирование следует применить (сумма, среднее, количество)?
-    3. Какие столбцы стоит вывести в качестве значений?
-
-    Верни только название столбца для группировки, тип агрегирования и названия столбцов для значений, разделенные запятыми.
-    """
-                            summary_response = chat_with_gpt(client, args.model, summary_prompt,
-                                                             temperature=0.5).strip()
-
-                            # Разбираем ответ
-                            parts = summary_response.split(',')
-                            if len(parts) >= 3:
-                                group_by = parts[0].strip()
-                                agg_type = parts[1].strip()
-                                value_cols = [col.strip() for col in parts[2:]]
-
-                                if group_by in df_result.columns:
-                                    # Создаем сводную таблицу
-                                    print(f"Создаю сводную таблицу с группировкой по '{group_by}'...")
-
-                                    # Определяем метод агрегации
-                                    agg_method = 'sum'
-                                    if 'сред' in agg_type.lower():
-                                        agg_method = 'mean'
-                                    elif 'колич' in agg_type.lower() or 'count' in agg_type.lower():
-                                        agg_method = 'count'
-
-                                    # Создаем словарь для агрегаций
-                                    agg_dict = {col: agg_method for col in value_cols if col in df_result.columns}
-
-                                    if agg_dict:
-                                        # Создаем сводную таблицу
-                                        pivot_df = df_result.groupby(group_by).agg(agg_dict).reset_index()
-                                        pivot_df.to_excel(writer, index=False, sheet_name='Сводная')
-                        except Exception as e:
-                            print(f"Не удалось создать сводную таблицу: {e}")
+                # Оптимизируем сохранение для больших результатов
+                with open_excel_writer(output_file) as writer:
+                    write_excel_sheet(writer, df_result, 'Результаты')
+                    if pivot_df is not None:
+                        write_excel_sheet(writer, pivot_df, 'Сводная')
 
                 print(f"Таблица успешно сохранена в файл: {output_file}")
 
-                # Создаем краткое описание результата
-                summary_prompt = f"""
-    Я создал таблицу по запросу пользователя: "{args.query}"
-
-    Получилась таблица размером {len(df_result)} строк на {len(df_result.columns)} столбцов.
-    Столбцы таблицы: {', '.join(df_result.columns.tolist())}
-
-    Первые 5 строк таблицы:
-    {df_result.head().to_string(index=False)}
-
-    Опиши кратко (2-3 предложения), что представляет собой эта таблица и какую информацию она содержит.
-    """
                 try:
-                    table_description = chat_with_gpt(client, args.model, summary_prompt, temperature=0.7)
+                    table_description = description_future.result()
                 except Exception as e:
                     table_description = f"Таблица успешно создана по вашему запросу. Содержит {len(df_result)} строк и {len(df_result.columns)} столбцов."
 
-                print("\n=== РЕЗУЛЬТАТ ДЛЯ ПОЛЬЗОВАТЕЛЯ ===\n")
-                print(table_description)
-                print(f"\nТаблица сохранена в файл: {output_file}")
+                print_user_result(table_description, output_file)
 
             except Exception as e:
                 print(f"Ошибка при сохранении результатов: {e}")
-                print("\n=== РЕЗУЛЬТАТ ДЛЯ ПОЛЬЗОВАТЕЛЯ ===\n")
-                print(
-                    f"Произошла ошибка при сохранении результатов: {e}. Пожалуйста, попробуйте с меньшим объемом данных.")
+                print_user_result(f"Произошла ошибка при сохранении результатов: {e}. Пожалуйста, попробуйте с меньшим объемом данных.")
             finally:
-                conn.close()
+                close_session(session)
 
     except KeyboardInterrupt:
         print("Прерывание выполнения пользователем.")
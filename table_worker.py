@@ -0,0 +1,57 @@
+"""Долгоживущий процесс для бота: выполняет запросы table_file_answer.py без запуска интерпретатора на каждый запрос.
+
+pandas, openpyxl, openai и сам table_file_answer импортируются один раз при старте. Задания приходят
+в stdin по одному JSON на строку ({"args": [...]} — аргументы командной строки table_file_answer.py),
+ответ на каждое уходит в stdout одной строкой JSON: {"returncode": код, "stdout": вывод скрипта}.
+"""
+import os
+import sys
+import io
+import json
+import contextlib
+
+import table_file_answer
+
+# Запросы выполняем только через sqlite3: по таймауту SQLite прерывает запрос сама, а поток ADBC
+# продолжал бы работать в этом процессе и во время следующих заданий
+table_file_answer.ADBC_QUERIES = False
+# Загруженные книги остаются открытыми между заданиями (до MAX_SESSIONS штук): повторный запрос к той же
+# книге не открывает базу и не читает схему заново
+table_file_answer.KEEP_SESSIONS = True
+
+
+def run_job(args):
+    """Выполняет table_file_answer.main() с заданными аргументами и возвращает код завершения и вывод."""
+    sys.argv = ['table_file_answer.py', *args]
+    output = io.StringIO()
+    returncode = 0
+    with contextlib.redirect_stdout(output):
+        try:
+            table_file_answer.main()
+        except SystemExit as e:
+            returncode = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+        except Exception as e:
+            print(f"Непредвиденная ошибка: {e}")
+            returncode = 1
+    return returncode, output.getvalue()
+
+
+def main():
+    # Ответы пишем в копию stdout, а сам дескриптор 1 направляем в stderr: случайный вывод
+    # библиотек мимо sys.stdout не смешается с ответами
+    replies = os.fdopen(os.dup(1), 'w', encoding='utf-8')
+    os.dup2(2, 1)
+
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        try:
+            returncode, output = run_job(json.loads(line)['args'])
+        except Exception as e:
+            returncode, output = 1, f"Ошибка в задании: {e}"
+        replies.write(json.dumps({'returncode': returncode, 'stdout': output}, ensure_ascii=False) + '\n')
+        replies.flush()
+
+
+if __name__ == "__main__":
+    main()
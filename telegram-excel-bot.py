@@ -1,42 +1,193 @@
 import os
+import sys
 import logging
 import tempfile
 import io
 import asyncio
 import subprocess
 import json
+import time
+import functools
+import threading
+import re
+import httplib2
+from collections import OrderedDict, Counter
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
 from google.oauth2 import service_account
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaIoBaseDownload
 from dotenv import load_dotenv
 
+try:
+    import uvloop
+except ImportError:  # без uvloop (например, на Windows) работает стандартный цикл событий asyncio
+    uvloop = None
+
 load_dotenv()
 
 # Настройка логирования
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
+# answer.py пишет в лог ход каждого вопроса (загрузка книги, SQL-запрос); в логе бота оставляем только
+# предупреждения и ошибки
+logging.getLogger('answer').setLevel(logging.WARNING)
 
 # ID папки Google Drive
 FOLDER_ID = '1uMBbz1UOkb9XJEImYOdfbiDpREeuVG-q'
+# Запрос Drive API: Excel-файлы (xls и xlsx) в папке, кроме удалённых
+DRIVE_LIST_QUERY = (f"'{FOLDER_ID}' in parents and trashed = false and (mimeType='application/vnd.ms-excel' "
+                    "or mimeType='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')")
+# Строка, после которой скрипты печатают ответ для пользователя
+RESULT_MARKER = "=== РЕЗУЛЬТАТ ДЛЯ ПОЛЬЗОВАТЕЛЯ ==="
+# Технические строки вывода скриптов, которые не попадают в ответ пользователю
+SKIPPED_OUTPUT_PREFIX = "Временная база данных"
+SKIPPED_OUTPUT_MARKERS = ("Все листы объединены", "Количество строк", "Получено строк")
+# Отладка цикла событий: ASYNCIO_DEBUG=1 включает режим отладки asyncio, и в лог попадают обработчики,
+# занявшие цикл дольше BOT_SLOW_CALLBACK секунд (например, случайный блокирующий вызов)
+ASYNCIO_DEBUG = bool(os.getenv('ASYNCIO_DEBUG'))
+BOT_SLOW_CALLBACK = float(os.getenv('BOT_SLOW_CALLBACK', '0.1'))
+# Как часто (в секундах) в режиме отладки писать в лог число задач цикла событий
+TASKS_LOG_INTERVAL = 60
+# Сколько долгоживущих процессов table_worker.py выполняют запросы на составление таблиц
+TABLE_WORKERS = 2
+# Предельная длина строки ответа процесса table_worker.py (весь вывод скрипта приходит одной строкой JSON)
+TABLE_WORKER_REPLY_LIMIT = 64 * 1024 * 1024
+# Сколько секунд ждать ответа table_worker.py на одно задание (таймаут SQL-запроса в скрипте 600 сек плюс вызовы
+# модели). Зависший процесс после этого завершается, чтобы не задерживать очередь остальных пользователей
+TABLE_JOB_TIMEOUT = 900
 
 # Временная директория для скачанных файлов
 temp_dir = tempfile.mkdtemp()
 logger.info(f"Создана временная директория для файлов: {temp_dir}")
 
+# Сколько скачанных файлов хранить в temp_dir: давно не использованные удаляются
+DOWNLOAD_CACHE_FILES = 20
+# Имя скачанного файла в кэше: {file_id}_{md5}{расширение}. Очистка temp_dir удаляет только такие файлы
+DOWNLOAD_NAME_RE = re.compile(r"^.+_[0-9a-f]{32}(\.[^.]*)?$")
+# Каталог дискового кэша ExcelQA (готовые базы SQLite книг) внутри temp_dir. Баз в нём хранится
+# не больше DOWNLOAD_CACHE_FILES, как и скачанных файлов
+QA_CACHE_DIR = os.path.join(temp_dir, 'qa_cache')
+
 # Глобальная переменная для сервиса Drive API
 drive_service = None
-# Словарь для хранения состояний пользователей
-user_states = {}
-# Словарь для хранения данных пользователей
-user_data = {}
+# Учетные данные сервисного аккаунта: по ним каждый поток создает свое HTTP-соединение
+drive_credentials = None
+# Потоки для блокирующих запросов к Drive API, чтобы они не останавливали цикл событий бота
+drive_executor = ThreadPoolExecutor(max_workers=4)
+# Свое соединение httplib2 для каждого потока drive_executor: httplib2.Http не потокобезопасен
+drive_thread_local = threading.local()
+# Кэш списка Excel-файлов по ID папки: {folder_id: (время получения, список файлов)}
+drive_list_cache = {}
+# Сколько секунд список файлов из кэша считается актуальным
+DRIVE_LIST_TTL = 30.0
+# Выполняющиеся запросы списка файлов по ID папки: одновременные нажатия ждут один и тот же запрос
+drive_list_inflight = {}
+# Загруженные для вопросов книги: {путь к файлу: ((размер, время изменения), ExcelQA)}
+excel_qa_cache = {}
+# Выполняющиеся загрузки книг по пути к файлу: одновременные первые вопросы ждут одну и ту же загрузку
+excel_qa_inflight = {}
+# Скачанные файлы, с которыми сейчас работают обработчики: {путь: число обработчиков}. Очистка их не удаляет
+files_in_use = Counter()
+# Асинхронный клиент OpenAI для вопросов по файлам, создаётся при первом вопросе
+answer_client = None
+# Очередь запросов на составление таблиц: (аргументы table_file_answer.py, future для ответа)
+table_jobs = asyncio.Queue()
 
 # Состояния бота
 STATE_IDLE = 'idle'
 STATE_WAITING_QUERY = 'waiting_query'
 STATE_CHAT_MODE = 'chat_mode'  # Новое состояние для режима чата
 
+
+@dataclass(slots=True)
+class UserSession:
+    """Состояние и данные одного пользователя: выбранный файл, тип действия и история чата."""
+    state: str = STATE_IDLE
+    file_id: str | None = None
+    file_name: str | None = None
+    file_path: str | None = None
+    action_type: str | None = None
+    query: str | None = None
+    chat_history: list = field(default_factory=list)
+    last_seen: float = field(default_factory=time.monotonic)
+
+
+# Сессии пользователей по user_id в порядке последнего обращения (LRU)
+sessions = OrderedDict()
+# Сколько сессий хранить в памяти: при превышении удаляется давно не активная
+MAX_SESSIONS = 10000
+# Сессия без обращений дольше этого времени (в секундах) удаляется фоновой очисткой
+SESSION_TTL = 3600
+# Как часто (в секундах) запускать фоновую очистку сессий
+SESSION_SWEEP_INTERVAL = 300
+
+
+def get_session(user_id):
+    """Возвращает сессию пользователя (создаёт новую при первом обращении) и отмечает её как активную."""
+    session = sessions.get(user_id)
+    if session is None:
+        session = sessions[user_id] = UserSession()
+        if len(sessions) > MAX_SESSIONS:
+            sessions.popitem(last=False)
+    else:
+        sessions.move_to_end(user_id)
+        session.last_seen = time.monotonic()
+    return session
+
+
+def reset_session(user_id):
+    """Сбрасывает состояние и данные пользователя."""
+    sessions.pop(user_id, None)
+    return get_session(user_id)
+
+
+def sweep_sessions():
+    """Удаляет сессии, неактивные дольше SESSION_TTL, и загруженные книги удалённых из temp_dir файлов."""
+    deadline = time.monotonic() - SESSION_TTL
+    # Сессии упорядочены по последнему обращению: устаревшие всегда в начале
+    while sessions and next(iter(sessions.values())).last_seen < deadline:
+        sessions.popitem(last=False)
+
+    # Книга, файл которой уже удалён из temp_dir, больше не понадобится. Объект не закрываем явно:
+    # соединение закроется, когда его отпустит последний ожидающий ответа вопрос
+    for file_path in [path for path in excel_qa_cache if not os.path.exists(path)]:
+        del excel_qa_cache[file_path]
+
+
+async def sweep_sessions_loop():
+    """Периодически запускает sweep_sessions, пока работает бот."""
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+        sweep_sessions()
+        logger.info(f"Очистка сессий: активных пользователей {len(sessions)}, загруженных книг {len(excel_qa_cache)}")
+
+
+async def log_tasks_loop():
+    """В режиме отладки периодически пишет в лог число задач цикла событий, чтобы заметить их накопление."""
+    while True:
+        await asyncio.sleep(TASKS_LOG_INTERVAL)
+        logger.info(f"Задач в цикле событий: {len(asyncio.all_tasks())}")
+
+
+async def post_init(application):
+    """Запускается после инициализации приложения: стартует фоновую очистку сессий и процессы для таблиц."""
+    if ASYNCIO_DEBUG:
+        loop = asyncio.get_running_loop()
+        loop.set_debug(True)
+        loop.slow_callback_duration = BOT_SLOW_CALLBACK
+        logger.info(f"Отладка asyncio включена: медленные обработчики (дольше {BOT_SLOW_CALLBACK} сек) попадут в лог")
+        application.create_task(log_tasks_loop())
+
+    application.create_task(sweep_sessions_loop())
+    for _ in range(TABLE_WORKERS):
+        application.create_task(table_worker_loop())
+
+
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Логирует ошибки, вызванные обновлениями."""
     logger.error(f"Произошла ошибка в обновлении {update}: {context.error}")
@@ -48,7 +199,7 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 def create_drive_service():
     """Создаем сервис Google Drive API с сервисным аккаунтом."""
-    global drive_service
+    global drive_service, drive_credentials
 
     try:
         service_account_json = os.getenv('SERVICE_ACCOUNT')
@@ -58,7 +209,8 @@ def create_drive_service():
         credentials = service_account.Credentials.from_service_account_info(
             service_account_info, scopes=['https://www.googleapis.com/auth/drive.readonly'])
 
-        # Строим сервис
+        # Строим сервис; запросы выполняются через соединения потоков drive_executor (см. thread_http)
+        drive_credentials = credentials
         drive_service = build('drive', 'v3', credentials=credentials)
         logger.info("Drive API сервис успешно создан")
         return True
@@ -82,28 +234,79 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
     # Сбрасываем состояние пользователя
-    user_states[user_id] = STATE_IDLE
-    if user_id in user_data:
-        user_data[user_id] = {}
+    reset_session(user_id)
 
     # Отправляем приветственное сообщение и запрашиваем список файлов
     await update.message.reply_text("Подключаюсь к Google Drive и получаю список файлов...")
     await list_excel_files(update, context)
 
 
+def thread_http():
+    """Возвращает авторизованное HTTP-соединение текущего потока (создаётся при первом запросе в потоке)."""
+    http = getattr(drive_thread_local, 'http', None)
+    if http is None:
+        http = drive_thread_local.http = AuthorizedHttp(drive_credentials, http=httplib2.Http())
+    return http
+
+
+def execute_request(request):
+    """Выполняет запрос Drive API через соединение текущего потока."""
+    return request.execute(http=thread_http())
+
+
+async def drive_call(request):
+    """Выполняет запрос Drive API в потоке drive_executor и возвращает ответ."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(drive_executor, execute_request, request)
+
+
+async def cached_list_excel_files(force=False):
+    """Возвращает список Excel-файлов папки, обращаясь к Drive API не чаще раза в DRIVE_LIST_TTL секунд.
+
+    force=True (явное нажатие «Обновить список») всегда запрашивает свежий список.
+    """
+    cached = drive_list_cache.get(FOLDER_ID)
+    if not force and cached is not None and time.monotonic() - cached[0] < DRIVE_LIST_TTL:
+        return cached[1]
+
+    # Если список уже запрашивается, ждём этот запрос вместо нового обращения к Drive
+    task = drive_list_inflight.get(FOLDER_ID)
+    if task is None:
+        task = asyncio.ensure_future(fetch_excel_files())
+        drive_list_inflight[FOLDER_ID] = task
+        task.add_done_callback(lambda _: drive_list_inflight.pop(FOLDER_ID, None))
+    # shield: отмена одного ожидающего обработчика не отменяет общий запрос
+    return await asyncio.shield(task)
+
+
+def cached_drive_file(file_id):
+    """Ищет файл по ID в последнем полученном списке файлов (без проверки срока годности); None, если его нет."""
+    cached = drive_list_cache.get(FOLDER_ID)
+    if cached is None:
+        return None
+    return next((item for item in cached[1] if item['id'] == file_id), None)
+
+
+async def fetch_excel_files():
+    """Запрашивает список Excel-файлов папки у Drive API и сохраняет его в кэш."""
+    results = await drive_call(drive_service.files().list(
+        q=DRIVE_LIST_QUERY,
+        pageSize=10,
+        fields="files(id, name, mimeType)"
+    ))
+
+    items = results.get('files', [])
+    drive_list_cache[FOLDER_ID] = (time.monotonic(), items)
+    return items
+
+
 async def list_excel_files(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Отображает список Excel-файлов из корневой папки."""
     user_id = update.effective_user.id
 
     try:
         # Получаем список Excel-файлов в папке
-        results = drive_service.files().list(
-            q=f"'{FOLDER_ID}' in parents and trashed = false and (mimeType='application/vnd.ms-excel' or mimeType='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')",
-            pageSize=10,
-            fields="files(id, name, mimeType)"
-        ).execute()
-
-        items = results.get('files', [])
+        items = await cached_list_excel_files()
 
         if not items:
             await update.message.reply_text(
@@ -111,11 +314,10 @@ async def list_excel_files(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
         else:
             # Формируем список кнопок для файлов
-            keyboard = []
-            for item in items:
-                keyboard.append([
-                    InlineKeyboardButton(f"📊 {item['name']}", callback_data=f"excel_{item['id']}")
-                ])
+            keyboard = [
+                [InlineKeyboardButton(f"📊 {item['name']}", callback_data=f"excel_{item['id']}")]
+                for item in items
+            ]
 
             # Добавляем кнопку для обновления списка
             keyboard.append([InlineKeyboardButton("🔄 Обновить список", callback_data="refresh_files")])
@@ -131,6 +333,111 @@ async def list_excel_files(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
 
+async def on_refresh_files(update: Update, context: ContextTypes.DEFAULT_TYPE, session):
+    """Кнопка «Обновить список»."""
+    # Пользователь явно просит обновить список: запрашиваем его у Drive в обход кэша
+    await refresh_files(update, context, force=True)
+
+
+async def on_file_button(update: Update, context: ContextTypes.DEFAULT_TYPE, file_id):
+    """Кнопка с Excel-файлом (callback_data вида excel_[file_id])."""
+    query = update.callback_query
+
+    # Обновляем сообщение, чтобы пользователь знал, что происходит обработка
+    await query.edit_message_text("Получаю информацию о файле...")
+
+    # Получаем имя файла по ID
+    try:
+        # Имя обычно уже есть в списке файлов, по которому построены кнопки; к Drive обращаемся, только если его нет
+        file = cached_drive_file(file_id)
+        if file is None:
+            file = await drive_call(drive_service.files().get(fileId=file_id, fields='name'))
+        file_name = file['name']
+
+        # Обработка большого файла
+        if file_name.endswith('.xlsx') or file_name.endswith('.xls'):
+            await query.edit_message_text(
+                f"Выбран файл: {file_name}\nПодготовка к обработке...")
+
+        # Переходим к выбору действий
+        await excel_file_selected(update, context, file_id, file_name)
+    except Exception as e:
+        logger.error(f"Ошибка при получении информации о файле: {e}")
+        await query.edit_message_text(f"Ошибка при получении информации о файле: {e}")
+
+
+async def on_action_question(update: Update, context: ContextTypes.DEFAULT_TYPE, session):
+    """Кнопка «Задать вопрос»."""
+    session.state = STATE_WAITING_QUERY
+    session.action_type = 'question'
+    await update.callback_query.edit_message_text(
+        f"Выбран файл: {session.file_name}\n\n"
+        "Введите ваш вопрос к данным:"
+    )
+
+
+async def on_action_table(update: Update, context: ContextTypes.DEFAULT_TYPE, session):
+    """Кнопка «Составить таблицу»."""
+    session.state = STATE_WAITING_QUERY
+    session.action_type = 'table'
+    await update.callback_query.edit_message_text(
+        f"Выбран файл: {session.file_name}\n\n"
+        "Опишите, какую таблицу нужно составить:"
+    )
+
+
+async def on_back_to_files(update: Update, context: ContextTypes.DEFAULT_TYPE, session):
+    """Кнопки «Выбрать другой файл» и возврат в главное меню: сбрасываем сессию и показываем список файлов."""
+    reset_session(update.effective_user.id)
+    await refresh_files(update, context)
+
+
+async def on_new_query(update: Update, context: ContextTypes.DEFAULT_TYPE, session):
+    """Кнопка «Новый запрос» для того же файла."""
+    action_type = session.action_type
+    session.state = STATE_WAITING_QUERY
+    await update.callback_query.edit_message_text(
+        f"Файл: {session.file_name}\n\n"
+        f"{'Введите новый вопрос к данным:' if action_type == 'question' else 'Опишите, какую таблицу нужно составить:'}"
+    )
+
+
+async def on_end_chat(update: Update, context: ContextTypes.DEFAULT_TYPE, session):
+    """Кнопка «Завершить чат»."""
+    # Очищаем историю чата, но оставляем информацию о файле
+    session.chat_history = []
+    session.state = STATE_IDLE
+
+    # Показываем меню действий
+    keyboard = [
+        [InlineKeyboardButton("🔄 Новый запрос", callback_data="new_query")],
+        [InlineKeyboardButton("📁 Выбрать другой файл", callback_data="main_menu")]
+    ]
+
+    await update.callback_query.edit_message_text(
+        "Чат завершен. Что делаем дальше?",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+
+async def on_generate_report(update: Update, context: ContextTypes.DEFAULT_TYPE, session):
+    """Кнопка «Сгенерировать отчет» на основе чата."""
+    await generate_report_from_chat(update, context)
+
+
+# Обработчики кнопок по callback_data (кроме кнопок файлов excel_[file_id])
+BUTTON_HANDLERS = {
+    "refresh_files": on_refresh_files,
+    "action_question": on_action_question,
+    "action_table": on_action_table,
+    "back_to_files": on_back_to_files,
+    "new_query": on_new_query,
+    "main_menu": on_back_to_files,
+    "end_chat": on_end_chat,
+    "generate_report": on_generate_report,
+}
+
+
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик нажатий на все кнопки."""
     query = update.callback_query
@@ -140,106 +447,25 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     await query.answer()  # Обязательно отвечаем на callback
 
-    if query.data == "refresh_files":
-        # Обновляем список файлов
-        await refresh_files(update, context)
-    elif query.data.startswith("excel_"):
-        # Пользователь выбрал Excel-файл
-        # Формат: excel_[file_id]
-        parts = query.data.split("_", 1)
-        if len(parts) == 2:
-            file_id = parts[1]  # Берем все, что после первого "_"
+    session = get_session(user_id)
 
-            # Обновляем сообщение, чтобы пользователь знал, что происходит обработка
-            await query.edit_message_text("Получаю информацию о файле...")
+    if query.data.startswith("excel_"):
+        # Пользователь выбрал Excel-файл. Формат: excel_[file_id], берем все, что после первого "_"
+        await on_file_button(update, context, query.data.split("_", 1)[1])
+        return
 
-            # Получаем имя файла по ID
-            try:
-                file = drive_service.files().get(fileId=file_id, fields='name').execute()
-                file_name = file['name']
+    handler = BUTTON_HANDLERS.get(query.data)
+    if handler is not None:
+        await handler(update, context, session)
 
-                # Обработка большого файла
-                if file_name.endswith('.xlsx') or file_name.endswith('.xls'):
-                    await query.edit_message_text(
-                        f"Выбран файл: {file_name}\nПодготовка к обработке...")
 
-                # Переходим к выбору действий
-                await excel_file_selected(update, context, file_id, file_name)
-            except Exception as e:
-                logger.error(f"Ошибка при получении информации о файле: {e}")
-                await query.edit_message_text(f"Ошибка при получении информации о файле: {e}")
-    elif query.data == "action_question":
-        # Пользователь выбрал "Задать вопрос"
-        user_states[user_id] = STATE_WAITING_QUERY
-        user_data[user_id]['action_type'] = 'question'
-        await query.edit_message_text(
-            f"Выбран файл: {user_data[user_id]['file_name']}\n\n"
-            "Введите ваш вопрос к данным:"
-        )
-    elif query.data == "action_table":
-        # Пользователь выбрал "Составить таблицу"
-        user_states[user_id] = STATE_WAITING_QUERY
-        user_data[user_id]['action_type'] = 'table'
-        await query.edit_message_text(
-            f"Выбран файл: {user_data[user_id]['file_name']}\n\n"
-            "Опишите, какую таблицу нужно составить:"
-        )
-    elif query.data == "back_to_files":
-        # Возвращаемся к списку файлов
-        user_states[user_id] = STATE_IDLE
-        if user_id in user_data:
-            user_data[user_id] = {}
-        await refresh_files(update, context)
-    elif query.data == "new_query":
-        # Новый запрос для того же файла
-        action_type = user_data[user_id]['action_type']
-        user_states[user_id] = STATE_WAITING_QUERY
-        await query.edit_message_text(
-            f"Файл: {user_data[user_id]['file_name']}\n\n"
-            f"{'Введите новый вопрос к данным:' if action_type == 'question' else 'Опишите, какую таблицу нужно составить:'}"
-        )
-    elif query.data == "main_menu":
-        # Возвращаемся в главное меню
-        user_states[user_id] = STATE_IDLE
-        if user_id in user_data:
-            user_data[user_id] = {}
-        await refresh_files(update, context)
-    elif query.data == "end_chat":
-        # Завершаем режим чата
-        # Очищаем историю чата, но оставляем информацию о файле
-        if 'chat_history' in user_data[user_id]:
-            del user_data[user_id]['chat_history']
-
-        user_states[user_id] = STATE_IDLE
-
-        # Показываем меню действий
-        keyboard = [
-            [InlineKeyboardButton("🔄 Новый запрос", callback_data="new_query")],
-            [InlineKeyboardButton("📁 Выбрать другой файл", callback_data="main_menu")]
-        ]
-
-        await query.edit_message_text(
-            "Чат завершен. Что делаем дальше?",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-    elif query.data == "generate_report":
-        # Генерируем отчет на основе чата
-        await generate_report_from_chat(update, context)
-
-
-async def refresh_files(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обновляет список файлов."""
+async def refresh_files(update: Update, context: ContextTypes.DEFAULT_TYPE, force=False):
+    """Обновляет список файлов (force=True — в обход кэша, по кнопке «Обновить список»)."""
     query = update.callback_query
 
     try:
         # Получаем список Excel-файлов в папке
-        results = drive_service.files().list(
-            q=f"'{FOLDER_ID}' in parents and trashed = false and (mimeType='application/vnd.ms-excel' or mimeType='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')",
-            pageSize=10,
-            fields="files(id, name, mimeType)"
-        ).execute()
-
-        items = results.get('files', [])
+        items = await cached_list_excel_files(force=force)
 
         if not items:
             await query.edit_message_text(
@@ -247,15 +473,13 @@ async def refresh_files(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
         else:
             # Формируем список кнопок для файлов
-            keyboard = []
-            for item in items:
-                keyboard.append([
-                    InlineKeyboardButton(f"📊 {item['name']}", callback_data=f"excel_{item['id']}")
-                ])
+            keyboard = [
+                [InlineKeyboardButton(f"📊 {item['name']}", callback_data=f"excel_{item['id']}")]
+                for item in items
+            ]
 
             # Добавляем кнопку для обновления списка с меткой времени для уникальности
-            from datetime import datetime
-            current_time = datetime.now().strftime("%H:%M:%S")
+            current_time = time.strftime("%H:%M:%S")
             keyboard.append(
                 [InlineKeyboardButton(f"🔄 Обновить список ({current_time})", callback_data="refresh_files")])
 
@@ -293,11 +517,9 @@ async def excel_file_selected(update: Update, context: ContextTypes.DEFAULT_TYPE
     user_id = update.effective_user.id
 
     # Сохраняем информацию о файле
-    if user_id not in user_data:
-        user_data[user_id] = {}
-
-    user_data[user_id]['file_id'] = file_id
-    user_data[user_id]['file_name'] = file_name
+    session = get_session(user_id)
+    session.file_id = file_id
+    session.file_name = file_name
 
     # Показываем меню действий
     keyboard = [
@@ -319,23 +541,24 @@ async def handle_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_query = update.message.text
 
     # Проверяем, есть ли пользователь в системе состояний
-    if user_id not in user_states:
+    if user_id not in sessions:
         return
 
-    current_state = user_states[user_id]
+    session = get_session(user_id)
+    current_state = session.state
 
     # Проверяем, в каком состоянии находится пользователь
     if current_state == STATE_WAITING_QUERY:
         # Начальный запрос пользователя
         # Проверяем, есть ли данные о файле
-        if user_id not in user_data or 'file_id' not in user_data[user_id]:
+        if session.file_id is None:
             await update.message.reply_text("Сначала выберите файл. Используйте /start для начала.")
             return
 
         logger.info(f"Получен запрос от пользователя {user_id}: {user_query}")
 
         # Сохраняем запрос
-        user_data[user_id]['query'] = user_query
+        session.query = user_query
 
         # Отправляем сообщение о начале обработки
         processing_message = await update.message.reply_text(
@@ -344,9 +567,9 @@ async def handle_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
         # Скачиваем файл
-        file_id = user_data[user_id]['file_id']
-        file_name = user_data[user_id]['file_name']
-        action_type = user_data[user_id]['action_type']
+        file_id = session.file_id
+        file_name = session.file_name
+        action_type = session.action_type
 
         try:
             # Скачиваем файл
@@ -358,53 +581,58 @@ async def handle_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
                 return
 
-            # Обновляем сообщение о статусе
-            await processing_message.edit_text(
-                f"Файл успешно скачан. Обрабатываю запрос: '{user_query}'"
-            )
+            # Пока запрос обрабатывается, файл не удаляется очисткой temp_dir
+            with using_file(downloaded_file_path):
+                # Обновляем сообщение о статусе
+                await processing_message.edit_text(
+                    f"Файл успешно скачан. Обрабатываю запрос: '{user_query}'"
+                )
 
-            # Сохраняем путь к файлу
-            user_data[user_id]['file_path'] = downloaded_file_path
-
-            if action_type == 'question':
-                # Инициализируем режим чата для запросов
-                await start_chat_mode(update, context, processing_message, user_query, downloaded_file_path)
-            else:
-                # Запускаем скрипт table_file_answer.py
-                result = await run_script('table_file_answer.py', downloaded_file_path, user_query)
-
-                # Если результат - файл
-                if os.path.exists('final.xlsx'):
-                    # Отправляем файл пользователю
-                    await processing_message.edit_text(
-                        f"Таблица готова! Отправляю файл..."
-                    )
+                # Сохраняем путь к файлу
+                session.file_path = downloaded_file_path
 
-                    with open('final.xlsx', 'rb') as file:
-                        await update.message.reply_document(
-                            document=file,
-                            filename='result.xlsx',
-                            caption="Результат обработки вашего запроса."
+                if action_type == 'question':
+                    # Инициализируем режим чата для запросов
+                    await start_chat_mode(update, context, processing_message, user_query, downloaded_file_path)
+                else:
+                    # Запускаем скрипт table_file_answer.py; у каждого пользователя свой файл результата,
+                    # чтобы одновременные запросы не перезаписывали файлы друг друга
+                    output_file = os.path.join(temp_dir, f"result_{user_id}.xlsx")
+                    result = await run_script('table_file_answer.py', downloaded_file_path, user_query,
+                                              output_file=output_file)
+
+                    # Если результат - файл
+                    if os.path.exists(output_file):
+                        # Отправляем файл пользователю
+                        await processing_message.edit_text(
+                            f"Таблица готова! Отправляю файл..."
                         )
 
-                    # Удаляем временный файл
-                    os.remove('final.xlsx')
-                else:
-                    # Отправляем текстовый результат
-                    await processing_message.edit_text(
-                        f"Результат обработки вашего запроса:\n\n{result}"
-                    )
+                        with open(output_file, 'rb') as file:
+                            await update.message.reply_document(
+                                document=file,
+                                filename='result.xlsx',
+                                caption="Результат обработки вашего запроса."
+                            )
+
+                        # Удаляем временный файл
+                        os.remove(output_file)
+                    else:
+                        # Отправляем текстовый результат
+                        await processing_message.edit_text(
+                            f"Результат обработки вашего запроса:\n\n{result}"
+                        )
 
-                # Показываем кнопки для дальнейших действий
-                keyboard = [
-                    [InlineKeyboardButton("🔄 Новый запрос", callback_data="new_query")],
-                    [InlineKeyboardButton("📁 Выбрать другой файл", callback_data="main_menu")]
-                ]
+                    # Показываем кнопки для дальнейших действий
+                    keyboard = [
+                        [InlineKeyboardButton("🔄 Новый запрос", callback_data="new_query")],
+                        [InlineKeyboardButton("📁 Выбрать другой файл", callback_data="main_menu")]
+                    ]
 
-                await update.message.reply_text(
-                    "Что делаем дальше?",
-                    reply_markup=InlineKeyboardMarkup(keyboard)
-                )
+                    await update.message.reply_text(
+                        "Что делаем дальше?",
+                        reply_markup=InlineKeyboardMarkup(keyboard)
+                    )
 
         except Exception as e:
             logger.error(f"Ошибка при обработке запроса: {e}")
@@ -420,41 +648,23 @@ async def handle_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def start_chat_mode(update: Update, context: ContextTypes.DEFAULT_TYPE, message_obj, user_query, file_path):
     """Начинает режим чата и обрабатывает первый вопрос."""
     user_id = update.effective_user.id
+    session = get_session(user_id)
 
     # Переходим в режим чата
-    user_states[user_id] = STATE_CHAT_MODE
-
-    # Инициализируем историю чата, если её нет
-    if 'chat_history' not in user_data[user_id]:
-        user_data[user_id]['chat_history'] = []
+    session.state = STATE_CHAT_MODE
 
     # Добавляем системный промпт для улучшения контекста
-    system_prompt = f"Ты ассистент, анализирующий Excel-файл '{user_data[user_id]['file_name']}'. Отвечай на вопросы о данных в этом файле. Будь точным и информативным."
+    system_prompt = f"Ты ассистент, анализирующий Excel-файл '{session.file_name}'. Отвечай на вопросы о данных в этом файле. Будь точным и информативным."
 
     # Добавляем первый вопрос пользователя в историю чата
-    user_data[user_id]['chat_history'].append({"role": "system", "content": system_prompt})
-    user_data[user_id]['chat_history'].append({"role": "user", "content": user_query})
-
-    # Запускаем скрипт answer.py с использованием нового параметра для истории чата
-    with tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False) as chat_file:
-        json.dump(user_data[user_id]['chat_history'], chat_file)
-        chat_history_path = chat_file.name
-
-    # Обрабатываем первый запрос
-    result = await run_script('answer.py', file_path, user_query, chat_history=chat_history_path)
+    session.chat_history.append({"role": "system", "content": system_prompt})
+    session.chat_history.append({"role": "user", "content": user_query})
 
-    # Удаляем временный файл с историей чата
-    if os.path.exists(chat_history_path):
-        os.remove(chat_history_path)
-
-    # Ищем раздел с результатом для пользователя
-    if "=== РЕЗУЛЬТАТ ДЛЯ ПОЛЬЗОВАТЕЛЯ ===" in result:
-        parts = result.split("=== РЕЗУЛЬТАТ ДЛЯ ПОЛЬЗОВАТЕЛЯ ===")
-        if len(parts) > 1:
-            result = parts[1].strip()
+    # Обрабатываем первый запрос с историей чата
+    result = await run_script('answer.py', file_path, user_query, chat_history=session.chat_history)
 
     # Добавляем ответ в историю чата
-    user_data[user_id]['chat_history'].append({"role": "assistant", "content": result})
+    session.chat_history.append({"role": "assistant", "content": result})
 
     # Отправляем ответ и добавляем кнопки
     keyboard = [
@@ -471,7 +681,8 @@ async def start_chat_mode(update: Update, context: ContextTypes.DEFAULT_TYPE, me
 async def process_chat_query(update: Update, context: ContextTypes.DEFAULT_TYPE, user_query):
     """Обрабатывает вопрос пользователя в режиме чата."""
     user_id = update.effective_user.id
-    file_path = user_data[user_id]['file_path']
+    session = get_session(user_id)
+    file_path = session.file_path
 
     # Отправляем сообщение о начале обработки
     processing_message = await update.message.reply_text(
@@ -479,28 +690,13 @@ async def process_chat_query(update: Update, context: ContextTypes.DEFAULT_TYPE,
     )
 
     # Добавляем вопрос пользователя в историю чата
-    user_data[user_id]['chat_history'].append({"role": "user", "content": user_query})
-
-    # Сохраняем историю чата во временный файл
-    with tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False) as chat_file:
-        json.dump(user_data[user_id]['chat_history'], chat_file)
-        chat_history_path = chat_file.name
+    session.chat_history.append({"role": "user", "content": user_query})
 
-    # Запускаем скрипт для получения ответа
-    result = await run_script('answer.py', file_path, user_query, chat_history=chat_history_path)
-
-    # Удаляем временный файл с историей чата
-    if os.path.exists(chat_history_path):
-        os.remove(chat_history_path)
-
-    # Ищем раздел с результатом для пользователя
-    if "=== РЕЗУЛЬТАТ ДЛЯ ПОЛЬЗОВАТЕЛЯ ===" in result:
-        parts = result.split("=== РЕЗУЛЬТАТ ДЛЯ ПОЛЬЗОВАТЕЛЯ ===")
-        if len(parts) > 1:
-            result = parts[1].strip()
+    # Получаем ответ с учётом истории чата
+    result = await run_script('answer.py', file_path, user_query, chat_history=session.chat_history)
 
     # Добавляем ответ в историю чата
-    user_data[user_id]['chat_history'].append({"role": "assistant", "content": result})
+    session.chat_history.append({"role": "assistant", "content": result})
 
     # Показываем кнопки действий
     keyboard = [
@@ -518,45 +714,32 @@ async def generate_report_from_chat(update: Update, context: ContextTypes.DEFAUL
     """Генерирует отчет на основе истории чата."""
     query = update.callback_query
     user_id = update.effective_user.id
+    session = get_session(user_id)
 
     await query.edit_message_text("Генерирую отчет на основе нашего диалога...")
 
     # Проверяем наличие истории чата
-    if 'chat_history' not in user_data[user_id] or len(user_data[user_id]['chat_history']) < 3:
+    if len(session.chat_history) < 3:
         await query.edit_message_text("Недостаточно данных для создания отчета. Задайте больше вопросов.")
         return
 
-    file_path = user_data[user_id]['file_path']
+    file_path = session.file_path
 
     # Создаем промпт для генерации отчета
     chat_summary = "\n".join([
         f"{msg['role'].upper()}: {msg['content']}"
-        for msg in user_data[user_id]['chat_history']
+        for msg in session.chat_history
         if msg['role'] != 'system'
     ])
 
     report_prompt = f"На основе нашего диалога создай структурированный отчет:"
 
-    # Сохраняем историю чата и промпт во временный файл
-    with tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False) as chat_file:
-        # Добавляем специальный запрос для создания отчета
-        report_history = user_data[user_id]['chat_history'].copy()
-        report_history.append({"role": "user", "content": report_prompt})
-        json.dump(report_history, chat_file)
-        chat_history_path = chat_file.name
-
-    # Запускаем скрипт для генерации отчета
-    result = await run_script('answer.py', file_path, report_prompt, chat_history=chat_history_path)
-
-    # Удаляем временный файл
-    if os.path.exists(chat_history_path):
-        os.remove(chat_history_path)
+    # Добавляем специальный запрос для создания отчета к копии истории чата
+    report_history = session.chat_history.copy()
+    report_history.append({"role": "user", "content": report_prompt})
 
-    # Ищем раздел с результатом
-    if "=== РЕЗУЛЬТАТ ДЛЯ ПОЛЬЗОВАТЕЛЯ ===" in result:
-        parts = result.split("=== РЕЗУЛЬТАТ ДЛЯ ПОЛЬЗОВАТЕЛЯ ===")
-        if len(parts) > 1:
-            result = parts[1].strip()
+    # Генерируем отчет
+    result = await run_script('answer.py', file_path, report_prompt, chat_history=report_history)
 
     # Отправляем результат
     await query.edit_message_text(f"Отчет на основе нашего диалога:\n\n{result}")
@@ -574,27 +757,83 @@ async def generate_report_from_chat(update: Update, context: ContextTypes.DEFAUL
     )
 
 
+def download_to_path(request, file_path):
+    """Блокирующее скачивание файла из Drive по частям; выполняется в потоке drive_executor."""
+    # Части файла запрашиваются через соединение этого потока, а не через общее соединение сервиса
+    request.http = thread_http()
+    with io.FileIO(file_path, 'wb') as fh:
+        # Размер части по умолчанию (100 МБ): обычная книга скачивается одним HTTP-запросом
+        downloader = MediaIoBaseDownload(fh, request)
+        done = False
+        last_decile = -1
+
+        # Скачиваем с отслеживанием прогресса; в лог пишем только каждые 10%
+        while not done:
+            status, done = downloader.next_chunk(num_retries=2)
+            progress = int(status.progress() * 100)
+            if progress // 10 != last_decile:
+                last_decile = progress // 10
+                logger.info(f"Скачивание: {progress}%")
+
+
+@contextmanager
+def using_file(file_path):
+    """Отмечает скачанный файл как используемый на время блока with, чтобы evict_downloads его не удалил."""
+    files_in_use[file_path] += 1
+    try:
+        yield file_path
+    finally:
+        files_in_use[file_path] -= 1
+        if not files_in_use[file_path]:
+            del files_in_use[file_path]
+
+
+def evict_downloads():
+    """Оставляет в temp_dir не больше DOWNLOAD_CACHE_FILES скачанных файлов, удаляя давно не использованные.
+
+    Рассматриваются только файлы кэша скачиваний (DOWNLOAD_NAME_RE): файлы результатов и другие файлы
+    temp_dir не трогаем. Файл, который сейчас обрабатывается или загружается в ExcelQA, пропускаем.
+    """
+    in_use = set(files_in_use) | {file_path for file_path, _ in excel_qa_inflight}
+    entries = sorted((entry for entry in os.scandir(temp_dir)
+                      if entry.is_file() and DOWNLOAD_NAME_RE.match(entry.name)),
+                     key=lambda entry: entry.stat().st_mtime, reverse=True)
+    for entry in entries[DOWNLOAD_CACHE_FILES:]:
+        if entry.path in in_use:
+            continue
+        try:
+            os.remove(entry.path)
+        except OSError as e:
+            logger.warning(f"Не удалось удалить старый файл {entry.path}: {e}")
+
+
 async def download_file(file_id, file_name):
-    """Скачивает файл из Google Drive."""
+    """Скачивает файл из Google Drive; уже скачанный файл с тем же содержимым берётся из temp_dir."""
     try:
+        # Контрольная сумма и размер из метаданных: запрос намного дешевле скачивания всего файла
+        meta = await drive_call(drive_service.files().get(fileId=file_id, fields='md5Checksum,size'))
+        md5 = meta.get('md5Checksum')
+        if md5:
+            # Имя файла в кэше содержит контрольную сумму: изменённый в Drive файл скачается заново
+            file_path = os.path.join(temp_dir, f"{file_id}_{md5}{os.path.splitext(file_name)[1]}")
+            if os.path.exists(file_path) and os.path.getsize(file_path) == int(meta.get('size', -1)):
+                # Обновляем время изменения, чтобы файл считался недавно использованным
+                os.utime(file_path)
+                logger.info(f"Файл уже скачан, используем его: {file_path}")
+                return file_path
+        else:
+            # Без контрольной суммы (например, у Google-таблиц) файл скачивается каждый раз
+            file_path = os.path.join(temp_dir, file_name)
+
         # Отправляем запрос на получение файла с прогрессом
         request = drive_service.files().get_media(fileId=file_id)
 
-        # Создаем файловый объект
-        file_path = os.path.join(temp_dir, file_name)
-
-        with io.FileIO(file_path, 'wb') as fh:
-            downloader = MediaIoBaseDownload(fh, request)
-            done = False
-
-            # Скачиваем с отслеживанием прогресса
-            while not done:
-                status, done = downloader.next_chunk()
-                progress = int(status.progress() * 100)
-                logger.info(f"Скачивание: {progress}%")
-                # Здесь можно было бы обновлять сообщение с прогрессом каждые 10%
+        # Весь цикл скачивания выполняем вне цикла событий: бот тем временем отвечает другим пользователям
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(drive_executor, download_to_path, request, file_path)
 
         logger.info(f"Файл успешно скачан: {file_path}")
+        evict_downloads()
         return file_path
 
     except Exception as e:
@@ -602,93 +841,188 @@ async def download_file(file_id, file_name):
         return None
 
 
-async def run_script(script_name, file_path, query, **kwargs):
-    """Запускает Python-скрипт и возвращает результат."""
+async def get_excel_qa(file_path):
+    """Возвращает ExcelQA для файла из answer.py: книга разбирается один раз и переиспользуется, пока файл не изменится."""
+    global answer_client
+
+    # answer.py (pandas, openpyxl, openai) импортируется при первом вопросе, а не при запуске бота
+    import answer
+
+    if answer_client is None:
+        answer_client = answer.create_client()
+
+    stat = os.stat(file_path)
+    version = (stat.st_size, stat.st_mtime_ns)
+    cached = excel_qa_cache.get(file_path)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    # Если эта версия файла уже загружается, ждём ту же загрузку вместо второй сборки той же базы
+    key = (file_path, version)
+    future = excel_qa_inflight.get(key)
+    if future is None:
+        # Разбор книги и загрузка в SQLite выполняются в потоке, чтобы не останавливать цикл событий
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(None, functools.partial(answer.ExcelQA, file_path, answer_client, cache=True,
+                                                              cache_dir=QA_CACHE_DIR))
+        excel_qa_inflight[key] = future
+        future.add_done_callback(functools.partial(store_excel_qa, key))
+    # shield: отмена одного ожидающего обработчика не отменяет общую загрузку
+    return await asyncio.shield(future)
+
+
+def store_excel_qa(key, future):
+    """Кладёт загруженную книгу в excel_qa_cache, когда загрузка завершилась.
+
+    Прежний объект не закрываем: им может пользоваться вопрос, который ещё ждёт ответа модели.
+    """
+    excel_qa_inflight.pop(key, None)
+    if not future.cancelled() and future.exception() is None:
+        file_path, version = key
+        excel_qa_cache[file_path] = (version, future.result())
+        evict_qa_cache()
+
+
+def evict_qa_cache():
+    """Оставляет в QA_CACHE_DIR не больше DOWNLOAD_CACHE_FILES баз, удаляя самые старые вместе с их описанием.
+
+    Базы книг из excel_qa_cache не удаляются: по ним ещё задают вопросы.
+    """
+    in_use = {qa.db_file for _, qa in excel_qa_cache.values()}
     try:
-        # Подготавливаем команду для запуска скрипта
-        if script_name == 'answer.py':
-            # Для скрипта вопросов
-            cmd = ["python", script_name, file_path, query]
-
-            # Добавляем путь к файлу истории чата, если есть
-            if 'chat_history' in kwargs and os.path.exists(kwargs['chat_history']):
-                # Проверяем, поддерживает ли скрипт chat-history
-                # Создаем процесс для проверки аргументов
-                check_process = await asyncio.create_subprocess_exec(
-                    "python", script_name, "--help",
-                    stdout=asyncio.subprocess.PIPE,
-                    stderr=asyncio.subprocess.PIPE
-                )
-                check_stdout, check_stderr = await check_process.communicate()
-                help_output = check_stdout.decode() + check_stderr.decode()
+        entries = sorted((entry for entry in os.scandir(QA_CACHE_DIR) if entry.name.endswith('.sqlite')),
+                         key=lambda entry: entry.stat().st_mtime, reverse=True)
+    except FileNotFoundError:
+        return
+    for entry in entries[DOWNLOAD_CACHE_FILES:]:
+        if entry.path in in_use:
+            continue
+        for path in (entry.path, os.path.splitext(entry.path)[0] + '.json'):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f"Не удалось удалить старую базу {path}: {e}")
+
+
+async def start_table_worker():
+    """Запускает процесс table_worker.py: он один раз импортирует table_file_answer и ждёт заданий.
+
+    Процесс работает под тем же интерпретатором (и виртуальным окружением), что и бот.
+    """
+    return await asyncio.create_subprocess_exec(
+        sys.executable, "table_worker.py",
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        limit=TABLE_WORKER_REPLY_LIMIT
+    )
 
-                # Если в выводе help есть упоминание chat-history, значит скрипт поддерживает этот аргумент
-                if "--chat-history" in help_output:
-                    cmd.extend(["--chat-history", kwargs['chat_history']])
-                    logger.info(f"Используем историю чата: {kwargs['chat_history']}")
-                else:
-                    logger.warning("Скрипт не поддерживает параметр --chat-history. Игнорируем историю чата.")
 
-            # Добавляем параметр кэширования для ускорения работы
-            cmd.append("--cache")
+async def table_worker_loop():
+    """Берёт задания из table_jobs и выполняет их в своём процессе table_worker.py.
 
-        else:
-            # Для скрипта создания таблиц
-            output_file = 'final.xlsx'
-            cmd = ["python", script_name, file_path, query, "--output", output_file]
-
-        # Запускаем процесс асинхронно
-        logger.info(f"Запускаем скрипт: {' '.join(cmd)}")
-
-        # Создаем процесс с отслеживанием вывода в реальном времени
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
+    Процесс запускается сразу (импорт pandas и openpyxl проходит до первого запроса), а если не запустился,
+    завершился или не ответил за TABLE_JOB_TIMEOUT секунд — заново перед следующим заданием. Ошибка запуска
+    процесса завершает ошибкой только текущее задание, а не весь цикл.
+    """
+    process = None
+    try:
+        process = await start_table_worker()
+    except Exception as e:
+        logger.error(f"Не удалось запустить процесс table_worker.py: {e}")
+
+    while True:
+        args, future = await table_jobs.get()
+        try:
+            if process is None or process.returncode is not None:
+                if process is not None:
+                    logger.warning("Процесс table_worker.py завершился, запускаем заново")
+                process = await start_table_worker()
+
+            process.stdin.write(json.dumps({'args': args}).encode() + b'\n')
+            await process.stdin.drain()
+            try:
+                line = await asyncio.wait_for(process.stdout.readline(), TABLE_JOB_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.error(f"Процесс table_worker.py не ответил за {TABLE_JOB_TIMEOUT} сек, перезапускаем")
+                raise
+            if not line:
+                raise RuntimeError("процесс table_worker.py завершился, не ответив на запрос")
+
+            if not future.done():
+                future.set_result(json.loads(line))
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+            # Ответ процесса мог остаться непрочитанным: следующее задание запустит новый процесс
+            if process is not None and process.returncode is None:
+                process.kill()
+                await process.wait()
+            process = None
+        finally:
+            table_jobs.task_done()
+
+
+async def run_table_job(args):
+    """Ставит запрос table_file_answer.py в очередь и ждёт ответа: {"returncode": код, "stdout": вывод}."""
+    future = asyncio.get_running_loop().create_future()
+    await table_jobs.put((args, future))
+    return await future
+
+
+def filter_script_output(text):
+    """Разбивает вывод скрипта на строки, убирая строки о временной базе данных и другую техническую информацию."""
+    lines = []
+    for line in text.splitlines():
+        line = line.rstrip()
+        if not (line.startswith(SKIPPED_OUTPUT_PREFIX) or any(marker in line for marker in SKIPPED_OUTPUT_MARKERS)):
+            lines.append(line)
+    return lines
 
-        # Функция для чтения вывода в реальном времени
-        async def read_stream(stream):
-            output = []
-            while True:
-                line = await stream.readline()
-                if not line:
-                    break
-                decoded_line = line.decode('utf-8').rstrip()
-                # Фильтруем строки о временной базе данных и другую техническую информацию
-                if not (decoded_line.startswith("Временная база данных") or
-                        "Все листы объединены" in decoded_line or
-                        "Количество строк" in decoded_line or
-                        "Получено строк" in decoded_line):
-                    logger.info(f"Вывод скрипта: {decoded_line}")
-                    output.append(decoded_line)
-            return output
-
-        # Запускаем параллельное чтение stdout и stderr
-        stdout_lines, stderr_lines = await asyncio.gather(
-            read_stream(process.stdout),
-            read_stream(process.stderr)
-        )
 
-        # Ждем завершения процесса
-        await process.wait()
+def extract_user_result(output):
+    """Возвращает текст после строки RESULT_MARKER или весь вывод, если её нет."""
+    i = output.find(RESULT_MARKER)
+    return output[i + len(RESULT_MARKER):].strip() if i >= 0 else output
+
+
+async def run_script(script_name, file_path, query, **kwargs):
+    """Запускает Python-скрипт и возвращает результат.
+
+    Вопросы (answer.py) обрабатываются в процессе бота через ExcelQA; chat_history — список сообщений.
+    Таблицы (table_file_answer.py) составляются в процессах table_worker.py; output_file — путь к файлу результата.
+    """
+    try:
+        if script_name == 'answer.py':
+            # Без запуска интерпретатора: книга уже загружена в базу, импорт pandas и разбор файла не повторяются
+            qa = await get_excel_qa(file_path)
+            answer_text, success = await qa.query(query, kwargs.get('chat_history'))
+            if not success:
+                logger.warning(f"Не удалось выполнить SQL-запрос для вопроса: {query}")
+            return answer_text
+
+        # Для скрипта создания таблиц: запрос выполняется в уже запущенном процессе table_worker.py
+        output_file = kwargs.get('output_file', 'final.xlsx')
+        args = [file_path, query, "--output", output_file]
+        logger.info(f"Запускаем скрипт: {script_name} {' '.join(args)}")
+
+        reply = await run_table_job(args)
+        stdout_lines = filter_script_output(reply['stdout'])
+        if stdout_lines:
+            logger.info("Вывод скрипта:\n" + "\n".join(stdout_lines))
 
         # Проверяем код завершения
-        if process.returncode != 0:
-            error_msg = "\n".join(stderr_lines)
+        if reply['returncode'] != 0:
+            error_msg = extract_user_result("\n".join(stdout_lines))
             logger.error(f"Скрипт вернул ошибку: {error_msg}")
             return f"Ошибка при выполнении скрипта: {error_msg}"
 
         # Обрабатываем результат
         result = "\n".join(stdout_lines)
 
-        # Ищем раздел с результатом для пользователя
-        if "=== РЕЗУЛЬТАТ ДЛЯ ПОЛЬЗОВАТЕЛЯ ===" in result:
-            parts = result.split("=== РЕЗУЛЬТАТ ДЛЯ ПОЛЬЗОВАТЕЛЯ ===")
-            if len(parts) > 1:
-                result = parts[1].strip()
-
-        return result
+        # Оставляем только раздел с результатом для пользователя
+        return extract_user_result(result)
 
     except asyncio.TimeoutError:
         logger.error(f"Таймаут при выполнении скрипта {script_name}")
@@ -703,9 +1037,7 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info(f"Пользователь {user_id} отменил операцию")
 
     # Сбрасываем состояние пользователя
-    user_states[user_id] = STATE_IDLE
-    if user_id in user_data:
-        user_data[user_id] = {}
+    reset_session(user_id)
 
     await update.message.reply_text(
         "Операция отменена. Используйте /start для начала работы."
@@ -723,8 +1055,12 @@ def main():
             logger.error("Не удалось создать сервис Drive API. Завершение работы.")
             return
 
+        # Цикл событий uvloop (libuv) быстрее стандартного: ставим его политику до создания приложения
+        if uvloop is not None:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
         # Создаем приложение с явными параметрами
-        application = Application.builder().token('7820736396:AAFGm7Xy3o3kI-HqC7EXzudXHF-pHyCltDA').build()
+        application = Application.builder().token('7820736396:AAFGm7Xy3o3kI-HqC7EXzudXHF-pHyCltDA').post_init(post_init).build()
 
         # Добавляем обработчики
         application.add_handler(CommandHandler("start", start))
@@ -0,0 +1,66 @@
+"""Проверки ExcelQA из answer.py на движке DuckDB (книга в памяти, без дискового кэша).
+
+Запуск: python -m unittest discover tests
+"""
+import os
+import sys
+import asyncio
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import answer
+
+
+class FakeCompletions:
+    """Вместо API OpenAI всегда отвечает заданным текстом."""
+
+    def __init__(self, content):
+        self.content = content
+
+    async def create(self, **kwargs):
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=self.content))])
+
+
+def fake_client(content):
+    return SimpleNamespace(chat=SimpleNamespace(completions=FakeCompletions(content)))
+
+
+@unittest.skipIf(answer.duckdb is None, "пакет duckdb не установлен")
+class ExcelQADuckDBTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.file_path = os.path.join(self.tmp_dir.name, 'sales.xlsx')
+        pd.DataFrame({'Город': ['Москва', 'Казань', 'Москва'], 'Сумма': [10, 20, 30]}).to_excel(
+            self.file_path, index=False)
+        client = fake_client("```sql\nSELECT COUNT(*) FROM data WHERE \"Город\" = 'Москва'\n```")
+        self.qa = answer.ExcelQA(self.file_path, client, engine='duckdb')
+
+    def tearDown(self):
+        self.qa.close()
+        self.tmp_dir.cleanup()
+
+    def test_engine(self):
+        self.assertEqual(self.qa.engine, 'duckdb')
+
+    def test_run_sql(self):
+        result = self.qa.run_sql('SELECT COUNT(*) AS n FROM data')
+        self.assertEqual(result['n'].tolist(), [3])
+
+    async def test_run_sql_from_threads(self):
+        results = await asyncio.gather(*(asyncio.to_thread(self.qa.run_sql, 'SELECT COUNT(*) AS n FROM data')
+                                         for _ in range(8)))
+        self.assertEqual([result['n'].iat[0] for result in results], [3] * 8)
+
+    async def test_query(self):
+        answer_text, success = await self.qa.query('Сколько продаж в Москве?')
+        self.assertTrue(success)
+        self.assertEqual(answer_text, 'Сколько продаж в Москве: 2')
+
+
+if __name__ == '__main__':
+    unittest.main()